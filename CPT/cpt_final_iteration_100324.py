@@ -1,254 +1,51 @@
 from psychopy import visual, core, event, data, logging, gui, clock
-from psychopy.visual.elementarray import ElementArrayStim
 from numpy.random import choice
 import random
 import os
+import sys
 import pandas as pd
 import numpy as np
-from scipy.spatial.distance import cdist
-from PIL import Image
-from enum import Enum
-
-# Define Color enum and color_filename_lookup
-class Color(Enum):
-    BLUE = 0
-    GREEN = 1
-    RED = 2
-    YELLOW = 3
-
-color_filename_lookup = {
-    Color.BLUE: "bird-blue.png",
-    Color.GREEN: "bird-green.png",
-    Color.RED: "bird-red.png",
-    Color.YELLOW: "bird-yellow.png"
-}
+
+# The flock simulation is shared with the SST variants in ../ssrt
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'ssrt'))
+import boids as flock
+from boids import Color, color_filename_lookup
+from boids_calibration import calibrate_flocks, calibration_info, scale_flock
 
 # Boids class
-class Boids:
-    def __init__(self, window, num_boids_map, max_boids_per_cell=5, boid_size=32):
-        self.window = window
-        self.n = sum(num_boids_map.values())
-        self.grid_size = 40
-        self.grid_cols = int(window.size[0] / self.grid_size) + 1
-        self.grid_rows = int(window.size[1] / self.grid_size) + 1
-        self.max_boids_per_cell = max_boids_per_cell
-        self.boid_size = boid_size
-
-        self.grid = np.full((self.grid_rows, self.grid_cols, self.max_boids_per_cell), -1, dtype=int)
-        self.grid_counts = np.zeros((self.grid_rows, self.grid_cols), dtype=int)
-
-        self.pos = np.random.rand(self.n, 2) - 0.5
-        self.pos[:,0] *= window.size[0]
-        self.pos[:,1] *= window.size[1]
-        self.vel = ((np.random.rand(self.n, 2) - 0.5) * 3)
-        self.acc = np.zeros((self.n, 2))
-        self.magnitudes = np.zeros((self.n, 1))
-        self.unit_vectors = np.zeros((self.n, 2))
-        self.intrinsic_speeds = ((np.random.rand(self.n, 1) * 0.1) + 0.9) * 1.1
-
-        self.num_boids_map = num_boids_map
-        self.setup_boids()
-
-        self.edge_distance = 100
-        self.edge_force = 0.3
-
-        # Initialize parameters with default values
-        self.coherence = 0.0005
-        self.separation = 0.004
-        self.alignment = 0.1
-        self.visual_range = 40
-        self.separation_distance = 30
+class Boids(flock.Boids):
+    # ElementArrayStims made so far, across all flocks, reported per trial
+    stim_allocations = 0
+    # Small sprites, as the birds are drawn at most 32 pixels across
+    tile_size = 32
+
+    def __init__(self, window, num_boids_map, boid_size=32):
+        super().__init__(window, num_boids_map, boid_size=boid_size, field_size=window.size)
 
     def setup_boids(self):
         self.update_grid()
 
-        # Load bird images
-        downscale_dims = (32, 32)  # Ensure this is a power of two
-        self.textures = {}
-        for color in Color:
-            img = Image.open(color_filename_lookup[color])
-            img.thumbnail(downscale_dims)
-            texture = visual.ImageStim(self.window, image=img, size=self.boid_size)
-            self.textures[color] = texture
-
-        self.boid_colors = []
+        self.atlas, self.aspect_ratios = flock.texture_atlas(self.tile_size)
+        # The areas are drawn together by flocks.show, on stimuli made by
+        # flocks.prepare
         self.shapes = []
-        current_index = 0
-        for color, count in self.num_boids_map.items():
-            self.boid_colors.extend([color] * count)
-            shape = visual.ElementArrayStim(
-                self.window,
-                units='pix',
-                nElements=count,
-                sizes=self.boid_size,
-                xys=self.pos[current_index:current_index+count],
-                elementTex=self.textures[color].image,
-                elementMask=None,
-                colorSpace='rgb',
-                colors=(1, 1, 1, 1)  # Set a default color (white) with alpha
-            )
-            self.shapes.append(shape)
-            current_index += count
-
-    def update_colors(self, new_color_ratio):
-        self.num_boids_map = new_color_ratio
-        new_boid_colors = []
-        new_shapes = []
-        current_index = 0
-
-        for color, count in new_color_ratio.items():
-            new_boid_colors.extend([color] * count)
-            shape = visual.ElementArrayStim(
-                self.window,
-                units='pix',
-                nElements=count,
-                sizes=self.boid_size,
-                xys=self.pos[current_index:current_index+count],
-                elementTex=self.textures[color].image,
-                elementMask=None,
-                colorSpace='rgb',
-                colors=(1, 1, 1, 1)  # Set a default color (white) with alpha
-            )
-            new_shapes.append(shape)
-            current_index += count
-
-        self.boid_colors = new_boid_colors
-        self.shapes = new_shapes
-        self.n = sum(new_color_ratio.values())
-
-        # Ensure pos and vel arrays match the new number of boids
-        if self.n != len(self.pos):
-            new_pos = np.random.rand(self.n, 2) - 0.5
-            new_pos[:,0] *= self.window.size[0]
-            new_pos[:,1] *= self.window.size[1]
-            new_vel = ((np.random.rand(self.n, 2) - 0.5) * 3)
-            
-            # Copy over existing positions and velocities
-            min_length = min(len(self.pos), self.n)
-            new_pos[:min_length] = self.pos[:min_length]
-            new_vel[:min_length] = self.vel[:min_length]
-            
-            self.pos = new_pos
-            self.vel = new_vel
-
-        # Update other arrays to match the new number of boids
-        self.acc = np.zeros((self.n, 2))
-        self.magnitudes = np.zeros((self.n, 1))
-        self.unit_vectors = np.zeros((self.n, 2))
-        self.intrinsic_speeds = ((np.random.rand(self.n, 1) * 0.1) + 0.9) * 1.1
-
-    def set_parameters(self, coherence=None, separation=None, alignment=None, visual_range=None, separation_distance=None):
-        if coherence is not None:
-            self.coherence = coherence
-        if separation is not None:
-            self.separation = separation
-        if alignment is not None:
-            self.alignment = alignment
-        if visual_range is not None:
-            self.visual_range = visual_range
-        if separation_distance is not None:
-            self.separation_distance = separation_distance
-
-    def update_grid(self):
-        self.grid.fill(-1)
-        self.grid_counts.fill(0)
-        grid_indices = np.floor((self.pos + np.array([self.window.size[0]/2, self.window.size[1]/2])) / self.grid_size).astype(int)
-        grid_indices = np.clip(grid_indices, [0, 0], [self.grid_cols-1, self.grid_rows-1])
-        for i, (col, row) in enumerate(grid_indices):
-            if self.grid_counts[row, col] < self.max_boids_per_cell:
-                self.grid[row, col, self.grid_counts[row, col]] = i
-                self.grid_counts[row, col] += 1
-
-    def get_nearby_boids(self, i):
-        pos = self.pos[i]
-        col, row = np.floor((pos + np.array([self.window.size[0]/2, self.window.size[1]/2])) / self.grid_size).astype(int)
-        nearby_cells = self.grid[max(0, row-1):min(self.grid_rows, row+2),
-                                 max(0, col-1):min(self.grid_cols, col+2)]
-        nearby_boids = nearby_cells[nearby_cells != -1]
-        return nearby_boids[nearby_boids != i]
-
-    def update(self):
-        self.update_grid()
-
-        new_vel = np.zeros_like(self.vel)
-
-        for i in range(self.n):
-            nearby_boids = self.get_nearby_boids(i)
-            if len(nearby_boids) == 0:
-                continue
-
-            nearby_pos = self.pos[nearby_boids]
-            nearby_vel = self.vel[nearby_boids]
-
-            dists = cdist([self.pos[i]], nearby_pos)[0]
-            within_distance_mask = dists < self.visual_range
-            avoid_mask = dists < self.separation_distance
-
-            near_positions = nearby_pos[within_distance_mask]
-            near_velocities = nearby_vel[within_distance_mask]
-            avoid_positions = nearby_pos[avoid_mask]
-
-            if len(near_velocities) > 0:
-                new_vel[i] += np.mean(near_velocities, axis=0) * self.alignment
-
-            if len(near_positions) > 0:
-                new_vel[i] += (np.mean(near_positions, axis=0) - self.pos[i]) * self.coherence
-
-            if len(avoid_positions) > 0:
-                new_vel[i] += np.sum(self.pos[i] - avoid_positions, axis=0) * self.separation
-
-        self.vel += new_vel
-
-        edge_forces = self.edge_avoidance()
-        self.vel += edge_forces
-
-        self.magnitudes = np.linalg.norm(self.vel, axis=1, keepdims=True)
-        self.unit_vectors = self.vel / self.magnitudes
-        np.clip(self.magnitudes, 1, 2.5, out=self.magnitudes)
-        self.vel = self.unit_vectors * self.magnitudes * self.intrinsic_speeds
-
-        self.pos += self.vel
-
-    def edge_avoidance(self):
-        left_edge = self.pos[:, 0] + self.window.size[0]/2
-        right_edge = self.window.size[0]/2 - self.pos[:, 0]
-        bottom_edge = self.pos[:, 1] + self.window.size[1]/2
-        top_edge = self.window.size[1]/2 - self.pos[:, 1]
 
-        force_x = np.zeros(self.n)
-        force_y = np.zeros(self.n)
-
-        mask = left_edge < self.edge_distance
-        force_x[mask] += self.edge_force
-
-        mask = right_edge < self.edge_distance
-        force_x[mask] -= self.edge_force
-
-        mask = bottom_edge < self.edge_distance
-        force_y[mask] += self.edge_force
-
-        mask = top_edge < self.edge_distance
-        force_y[mask] -= self.edge_force
-
-        return np.column_stack((force_x, force_y))
-
-    def show(self):
-        oris = np.degrees(np.arctan2(self.vel[:,0], self.vel[:,1])) % 360
-        current_index = 0
-        for shape in self.shapes:
-            count = shape.nElements
-            shape.setOris(oris[current_index:current_index+count])
-            shape.setXYs(self.pos[current_index:current_index+count,:])
-            shape.draw()
-            current_index += count
-
-    def randomize_positions(self):
-        self.pos = np.random.rand(self.n, 2) - 0.5
-        self.pos[:,0] *= self.window.size[0]
-        self.pos[:,1] *= self.window.size[1]
-
-    def randomize_velocities(self):
-        self.vel = ((np.random.rand(self.n, 2) - 0.5) * 3)
+    def make_stim(self, n):
+        Boids.stim_allocations += 1
+        return visual.ElementArrayStim(
+            self.window,
+            units='pix',
+            nElements=n,
+            sizes=self.boid_size,
+            elementTex=self.atlas,
+            elementMask=None,
+            colorSpace='rgb',
+            colors=(1, 1, 1, 1)  # Set a default color (white) with alpha
+        )
+
+    def sprite_sizes(self):
+        # The CPT draws its birds square
+        return np.full((self.n, 2), float(self.boid_size))
 
 # Create a GUI dialog 
 exp_info = {
@@ -269,6 +66,8 @@ os.chdir(set_directory)
 win = visual.Window([1000, 800], color='white', fullscr=False, units='height')
 fixation = visual.TextStim(win, text="+", color="gray", height=0.05)
 stimulus = visual.TextStim(win, text='', color='black', height=0.3)
+# Decode the bird sprites before the first block rather than mid-block
+flock.prewarm_textures((Boids.tile_size,))
 
 # Set parameters
 letters = [chr(i) for i in range(65, 91)]
@@ -280,9 +79,14 @@ trials_per_block = 60 if not exp_info['test_mode'] else 20
 targets_per_block = 6 if not exp_info['test_mode'] else 2
 isi_duration = [0.25, 1.25, 3.25]
 isi_static_addition = 0.75
+# Fraction of the designed flock size drawn, set by the startup calibration
+boid_scale = 1.0
 
 # Define boid areas
 box_size = (250, 250)
+# Least distance between boids when a flock is placed: the diagonal of their
+# 16 pixel sprites, so no two overlap at any orientation
+boid_spacing = 16 * np.sqrt(2)
 boid_areas = {
     'top_left': {'pos': (-300, 250), 'size': box_size},
     'top_right': {'pos': (300, 250), 'size': box_size},
@@ -293,6 +97,13 @@ boid_areas = {
 # Create boids for each area (initially set to None)
 boids = {area: None for area in boid_areas}
 
+# Steps the boids of every active area together
+flocks = flock.Flocks()
+# Boids within this many pixels of the fixation cross count as near it; it
+# reaches into the inner corners of the boid areas
+fixation_radius = 300
+flocks.metrics = flock.FlockMetrics(fixation=(0, 0), fixation_radius=fixation_radius)
+
 # Create area boundaries
 area_boundaries = {}
 for area, details in boid_areas.items():
@@ -336,7 +147,7 @@ def get_boid_color_ratio(block_num, trial_num):
     #         return {Color.GREEN: 8, Color.RED: 4, Color.BLUE: 4, Color.YELLOW: 4}
     
     # Default to equal distribution for other blocks
-    return {Color.RED: 5, Color.BLUE: 5, Color.GREEN: 5, Color.YELLOW: 5}
+    return scale_flock({Color.RED: 5, Color.BLUE: 5, Color.GREEN: 5, Color.YELLOW: 5}, boid_scale)
 
 def get_boid_parameters(block_num, trial_num):
     params = {
@@ -387,36 +198,36 @@ def get_active_areas(block_num, trial_num):
 
     return active_areas, static_distractor_area
 
-def create_boids(area, color_ratio, boid_params):
+def area_bounds(area):
     details = boid_areas[area]
+    left_bound = details['pos'][0] - details['size'][0]/2
+    right_bound = details['pos'][0] + details['size'][0]/2
+    bottom_bound = details['pos'][1] - details['size'][1]/2
+    top_bound = details['pos'][1] + details['size'][1]/2
+    return left_bound, right_bound, bottom_bound, top_bound
+
+def create_boids(area, color_ratio, boid_params):
     new_boids = Boids(win, color_ratio, boid_size=16)
-    new_boids.pos[:, 0] = np.random.uniform(details['pos'][0] - details['size'][0]/2, details['pos'][0] + details['size'][0]/2, new_boids.n)
-    new_boids.pos[:, 1] = np.random.uniform(details['pos'][1] - details['size'][1]/2, details['pos'][1] + details['size'][1]/2, new_boids.n)
+    # Boids bounce off the edges of their area, with no pull from the window edges
+    new_boids.set_boundary('reflect', area_bounds(area))
+    # and start spread out over it, without overlapping
+    new_boids.spread(boid_spacing)
     new_boids.set_parameters(**boid_params)
+    flocks.add(area, new_boids)
     return new_boids
 
 def update_and_draw_boids(active_areas):
-    for area in active_areas:
-        if boids[area] is not None:
-            boid = boids[area]
-            boid.update()
-            details = boid_areas[area]
-
-            # Check for boundary collisions and adjust velocities
-            left_bound = details['pos'][0] - details['size'][0]/2
-            right_bound = details['pos'][0] + details['size'][0]/2
-            bottom_bound = details['pos'][1] - details['size'][1]/2
-            top_bound = details['pos'][1] + details['size'][1]/2
-
-            # Reverse velocity when hitting boundaries
-            boid.vel[:, 0] = np.where((boid.pos[:, 0] <= left_bound) | (boid.pos[:, 0] >= right_bound), -boid.vel[:, 0], boid.vel[:, 0])
-            boid.vel[:, 1] = np.where((boid.pos[:, 1] <= bottom_bound) | (boid.pos[:, 1] >= top_bound), -boid.vel[:, 1], boid.vel[:, 1])
-
-            # Ensure boids stay within boundaries
-            boid.pos[:, 0] = np.clip(boid.pos[:, 0], left_bound, right_bound)
-            boid.pos[:, 1] = np.clip(boid.pos[:, 1], bottom_bound, top_bound)
-
-            boid.show()
+    # The areas are simulated live rather than replayed from boids_replay's
+    # cache (as the SST boids block is): their colours and parameters can
+    # change from trial to trial and each area's flock carries on across
+    # trials, the frame governor changes the level of detail from the
+    # measured frame times, and the boid_* metrics are taken from the
+    # simulation itself
+    active_areas = [area for area in active_areas if boids[area] is not None]
+    # Fixed-rate simulation, independent of the monitor's refresh rate
+    flocks.advance_to(core.getTime(), active_areas)
+    # All the active areas in one draw call
+    flocks.show(active_areas)
 
 def block(block_num, num_stimuli, num_targets):
     block.dynamic_distractor = None
@@ -445,12 +256,17 @@ def block(block_num, num_stimuli, num_targets):
         # Update colors and parameters for existing boids
         color_ratio = get_boid_color_ratio(block_num, stim_num + 1)
         boid_params = get_boid_parameters(block_num, stim_num + 1)
+        stim_allocations_before = Boids.stim_allocations
+        detail_changes_before = len(flocks.governor.changes)
+        flocks.metrics.reset()
         for area in active_areas:
             if boids[area] is None:
                 boids[area] = create_boids(area, color_ratio, boid_params)
             else:
                 boids[area].update_colors(color_ratio)
                 boids[area].set_parameters(**boid_params)
+        # Make this trial's stimuli now rather than on its first frames
+        flocks.prepare([area for area in active_areas if boids[area] is not None])
 
         stimulus.text = stim
         rt_clock = core.Clock()
@@ -516,11 +332,28 @@ def block(block_num, num_stimuli, num_targets):
         this_exp.addData('static_distractor_present', static_distractor_area)
         this_exp.addData('boid_color_ratio', str(color_ratio))
         this_exp.addData('boid_parameters', str(boid_params))
+        this_exp.addData('boid_detail_level', flocks.governor.level)
+        this_exp.addData('boid_detail_changes', str(flocks.governor.changes[detail_changes_before:]))
+        this_exp.addData('boid_stim_allocations', Boids.stim_allocations - stim_allocations_before)
+        # How the boids looked over the trial, averaged over simulation steps
+        for name, value in flocks.metrics.summary().items():
+            this_exp.addData(f'boid_{name}', value)
         this_exp.nextEntry()
 
     # Clear all boids at the end of each block
     for area in boids:
         boids[area] = None
+    flocks.clear()
+
+def calibration_flocks(scale):
+    # Every area active at once, the heaviest condition of the task
+    test_flocks = flock.Flocks()
+    for area in boid_areas:
+        test_boids = Boids(win, scale_flock(get_boid_color_ratio(0, 1), scale), boid_size=16)
+        test_boids.set_boundary('reflect', area_bounds(area))
+        test_boids.spread(boid_spacing)
+        test_flocks.add(area, test_boids)
+    return test_flocks
 
 def show_example_slider(win):
     example_text = visual.TextStim(win, text="Example: How much do you like ice cream?", 
@@ -615,6 +448,17 @@ Unless it is the letter "X"!
 The experimenter will continue the task when you are ready!
 '''
 
+# Measure this machine and draw as many boids as it can keep up with, up to
+# the designed flock; what was picked is saved with every row of the data
+calibration = calibrate_flocks(win, calibration_flocks)
+boid_scale = calibration['flock_scale']
+calibration_columns = calibration_info(calibration)
+this_exp.extraInfo.update(calibration_columns)
+
+# Lowers the boids' level of detail if they start costing frames (e.g. with
+# all four areas active on older machines), so RT timing stays intact
+flocks.governor = flock.FrameGovernor(frame_rate=calibration['refresh_rate'])
+
 # Main experiment
 instruction_texts = [
     '''
@@ -668,7 +512,7 @@ logging.flush()
 
 # Clean and save data
 df = pd.read_csv(filename + ".csv")
-df_clean = df.filter(['age', 'gender', 'participant_id', 'trial_num', 'stimulus', 'response_key', 'reaction_time', 'accuracy', 'date', 'block_num', 'boids_present', 'static_distractor_present', 'boid_color_ratio', 'boid_parameters', 'metacognitive_responses'])
+df_clean = df.filter(['age', 'gender', 'participant_id', 'trial_num', 'stimulus', 'response_key', 'reaction_time', 'accuracy', 'date', 'block_num', 'boids_present', 'static_distractor_present', 'boid_color_ratio', 'boid_parameters', 'boid_detail_level', 'boid_detail_changes', 'boid_stim_allocations', 'boid_polarization', 'boid_nearest_neighbour', 'boid_speed', 'boid_near_fixation', 'boid_steps', 'metacognitive_responses'] + list(calibration_columns))
 
 # Add individual columns for each metacognitive question
 metacognitive_questions = [
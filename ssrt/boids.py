@@ -1,24 +1,38 @@
 # Two Behaviors:
-#   Numerosity Behavior: 
+#   Numerosity Behavior: (starting layouts from poisson_disk_layouts)
 #     Unrestricted direction of flight, some fraction colored a different color
 #     Boids turn at boundaries instead of wrapping around the screen
-#   Dot Kinematography: 
+#   Dot Kinematography: (Boids.set_kinematogram)
 #     Boids wrap around screen
 #       Or: boids are bounded on top and bottom, but wrap left and right
 #       some portion exhibit a strong tendency to align in a certain direction (left or right)
 #       others fly in a random direction (and don't interact with the rest)
 #       some element of randomness in their behavior...
 
+import os
+import time
+from collections import deque
 from psychopy import visual, core, event, logging
 from psychopy.visual.elementarray import ElementArrayStim
+from psychopy.tools.monitorunittools import convertToPix
 import numpy as np
-from scipy.spatial.distance import cdist
+from scipy.spatial import cKDTree
 from PIL import Image
 from enum import Enum
 
+try:
+    import boids_compiled
+except ImportError:
+    # numba is optional; without it Boids runs on NumPy alone
+    boids_compiled = None
+import boids_renderer
+
 WINDOW_WIDTH = 1000
 WINDOW_HEIGHT = 800
 
+# Simulation steps per second that velocities and forces are tuned for
+STEP_RATE = 60
+
 class Color(Enum):
   BLUE = 0
   GREEN = 1
@@ -32,190 +46,1467 @@ color_filename_lookup = {
     Color.YELLOW: "bird-yellow.png"
 }
 
+# The bird sprites share one texture, a square of ATLAS_TILES x ATLAS_TILES
+# tiles with colour c in tile c.value
+ATLAS_TILES = 2
+
+# How a flock is kept inside its region, per axis (see Boids.set_boundary):
+# SOFT pushes boids back once they come within edge_distance of an edge,
+# REFLECT bounces them off it and WRAP carries them round to the opposite edge
+SOFT, REFLECT, WRAP = 0, 1, 2
+BOUNDARY_MODES = {
+    'soft': (SOFT, SOFT),
+    'reflect': (REFLECT, REFLECT),
+    'wrap': (WRAP, WRAP),
+    # Wrap round left and right, bounce off the top and bottom
+    'wrap_x': (WRAP, REFLECT),
+    'wrap_y': (REFLECT, WRAP),
+}
+
+# Ways of finding each boid's neighbours, see Boids.neighbour_pairs
+NEIGHBOUR_BACKENDS = ('grid', 'kdtree')
+# Simulation paths to choose between: each NumPy neighbour backend, plus the
+# numba kernel when numba is installed. See backend_options
+BACKENDS = NEIGHBOUR_BACKENDS + (('compiled',) if boids_compiled is not None else ())
+
+# What draws the boids: PsychoPy's ElementArrayStim, or
+# boids_renderer.InstancedSprites, which uploads far less per frame for large flocks
+RENDERERS = ('elements', 'instanced')
+
+# Precisions the flock state can be kept in, with the integer type used for
+# its grid cells and indices. float32 halves the memory the update streams
+# through and is what ElementArrayStim hands to the GPU anyway
+STATE_DTYPES = {np.dtype(np.float64): np.int64, np.dtype(np.float32): np.int32}
+# The numba kernel only runs float64 flocks. In float32 its arithmetic rounds
+# differently from the NumPy update (which sums neighbours in float64 through
+# bincount), and flocking amplifies the difference within a few hundred steps,
+# so float32 flocks always take the NumPy path and move the same either way
+COMPILED_DTYPES = (np.dtype(np.float64),)
+
+# Decoded sprites and atlases, shared by every Boids in the process. Keyed by
+# (file, size, format), with all the sprite files for an atlas; the arrays are
+# read-only so they can be handed out as is
+texture_cache = {}
+
+def load_texture(filename, size, mode="RGBA"):
+    # Image file as a float32 texture array of size (width, height) in the -1
+    # to 1 range, bottom row first, and the image's original width / height.
+    # Each file is only read and decoded the first time
+    key = (os.path.abspath(filename), tuple(size), mode)
+    if key not in texture_cache:
+        img = Image.open(filename).convert(mode)
+        aspect_ratio = img.size[0] / img.size[1]
+        img = img.resize(tuple(size), Image.BILINEAR)
+        data = ((np.asarray(img, dtype="int32") / 255) * 2 - 1).astype(np.float32)
+        data = np.ascontiguousarray(data[::-1,])
+        data.setflags(write=False)
+        texture_cache[key] = (data, aspect_ratio)
+    return texture_cache[key]
+
+def texture_atlas(tile_size=256):
+    # All the bird sprites in one texture, so a flock of any mix of colours is
+    # drawn by a single ElementArrayStim. Each sprite is stretched to fill a
+    # square tile; the element sizes give the birds back their aspect ratio.
+    # Returns the atlas and each colour's width / height, cached like load_texture
+    # The resolved sprite files are part of the key, as the same file names
+    # point at different sprites from different working directories
+    sprites = tuple(os.path.abspath(color_filename_lookup[color]) for color in Color)
+    key = ("atlas", sprites, (tile_size, tile_size), "RGBA")
+    if key not in texture_cache:
+        atlas = np.zeros((ATLAS_TILES * tile_size, ATLAS_TILES * tile_size, 4), dtype=np.float32)
+        aspect_ratios = np.ones(ATLAS_TILES ** 2)
+        for color in Color:
+            data, aspect_ratios[color.value] = load_texture(color_filename_lookup[color], (tile_size, tile_size))
+            row, col = divmod(color.value, ATLAS_TILES)
+            atlas[row * tile_size:(row + 1) * tile_size, col * tile_size:(col + 1) * tile_size] = data
+        atlas.setflags(write=False)
+        aspect_ratios.setflags(write=False)
+        texture_cache[key] = (atlas, aspect_ratios)
+    return texture_cache[key]
+
+def prewarm_textures(tile_sizes=(256,)):
+    # Decode the sprites at startup, so making a Boids later reads no files
+    for tile_size in tile_sizes:
+        texture_atlas(tile_size)
+
+def atlas_coords(color_ids):
+    # Spatial frequencies and phases that crop each element's texture to the
+    # tile of its colour. In pix units an element shows texture coordinates
+    # 0.5 - phase -/+ sf / 2, so an sf of one tile and a phase of
+    # 0.5 - (tile + 0.5) / ATLAS_TILES cover exactly that tile
+    row, col = np.divmod(color_ids, ATLAS_TILES)
+    tiles = np.column_stack((col, row))
+    sfs = np.full((len(color_ids), 2), 1 / ATLAS_TILES)
+    phases = 0.5 - (tiles + 0.5) / ATLAS_TILES
+    return sfs, phases
+
+def release_stim(stim):
+    # Free the GL objects of a stimulus that is no longer drawn. PsychoPy
+    # frees an ElementArrayStim's own when it is garbage collected
+    if isinstance(stim, boids_renderer.InstancedSprites):
+        stim.release()
+
+# Per-boid arrays of a Boids, with the shape of one boid's entry. They are
+# kept at the flock's capacity, see Boids.allocate_storage
+STATE_SHAPES = {
+    'pos': (2,), 'vel': (2,), 'acc': (2,), 'magnitudes': (1,), 'unit_vectors': (2,), 'intrinsic_speeds': (1,),
+    'color_ids': (),
+    # Scratch buffers, so a frame allocates no per-boid arrays
+    'forces': (2,), 'edge_forces': (2,), 'edge_gaps': (), 'drift': (2,), 'obstacle_cells': (), 'obstacle_push': (),
+    'obstacle_forces': (2,), 'oris': (), 'render_buffer': (2,),
+}
+# State kept in one type whatever the flock's dtype; the obstacle grids are
+# always float64
+FIXED_STATE_DTYPES = {'color_ids': int, 'obstacle_cells': int, 'obstacle_push': float, 'obstacle_forces': float}
+
+def color_ids(num_boids_map):
+    # Color value of each boid, in the order of num_boids_map
+    return np.repeat([color.value for color in num_boids_map], list(num_boids_map.values())).astype(int)
+
+def backend_options(backend):
+    # Boids keyword arguments that select one of BACKENDS
+    if backend == 'compiled':
+        return {'compiled': True}
+    return {'neighbours': backend, 'compiled': False}
+
+def poisson_disk_layouts(layouts, n, region, min_distance, max_rounds=100, random=np.random):
+    # layouts independent sets of n positions inside region (left, right,
+    # bottom, top), no two of a set closer than min_distance, as a
+    # (layouts, n, 2) array, drawn from random (a RandomState or np.random).
+    # Darts are thrown at every unfinished layout at once and checked against
+    # a background grid of cells min_distance / sqrt(2) wide, which holds at
+    # most one point each, so only the 5x5 block of cells around a dart can
+    # hold a point too close to it. The layouts sit side by
+    # side in one grid, two empty cells apart, so one lookup serves them all
+    left, right, bottom, top = region
+    size = np.array([right - left, top - bottom], dtype=float)
+    cell = min_distance / np.sqrt(2)
+    cols, rows = np.ceil(size / cell).astype(int)
+    grid = np.full((layouts * (cols + 2) + 2, rows + 4), -1)
+    offsets = np.array([(col, row) for col in range(-2, 3) for row in range(-2, 3)])
+
+    points = np.zeros((layouts * n, 2))
+    counts = np.zeros(layouts, dtype=int)
+    for _ in range(max_rounds):
+        short = np.flatnonzero(counts < n)
+        if len(short) == 0:
+            return points.reshape(layouts, n, 2) + (left, bottom)
+        needed = n - counts[short]
+        layout_ids = np.repeat(short, 2 * needed + 8)
+        darts = random.rand(len(layout_ids), 2) * size
+        cells = (darts // cell).astype(int) + 2
+        cells[:, 0] += layout_ids * (cols + 2)
+
+        # Darts too close to a point already placed
+        near = grid[cells[:, None, 0] + offsets[:, 0], cells[:, None, 1] + offsets[:, 1]]
+        gaps = darts[:, None, :] - points[near]
+        too_close = ((np.einsum('ijk,ijk->ij', gaps, gaps) < min_distance ** 2) & (near >= 0)).any(axis=1)
+        candidates = np.flatnonzero(~too_close)
+
+        # Of darts too close to each other, keep the first. Layouts are moved
+        # apart so darts of different layouts never meet
+        shifted = darts[candidates] + np.outer(layout_ids[candidates], (size[0] + 2 * min_distance, 0))
+        pairs = cKDTree(shifted).query_pairs(min_distance, output_type='ndarray')
+        keep = np.ones(len(candidates), dtype=bool)
+        keep[pairs.max(axis=1)] = False
+        accepted = candidates[keep]
+
+        # Up to as many as each layout still needs; darts are in layout order
+        ids = layout_ids[accepted]
+        rank = np.arange(len(accepted)) - np.searchsorted(ids, ids)
+        fits = rank < n - counts[ids]
+        accepted, ids, rank = accepted[fits], ids[fits], rank[fits]
+        index = ids * n + counts[ids] + rank
+        points[index] = darts[accepted]
+        grid[cells[accepted, 0], cells[accepted, 1]] = index
+        counts += np.bincount(ids, minlength=layouts)
+    raise ValueError(f"Could not fit {n} boids {min_distance} apart into {size[0]:g} x {size[1]:g} "
+                     f"in {max_rounds} rounds; use fewer boids or a smaller distance")
+
+def poisson_disk_layout(n, region, min_distance, random=np.random):
+    # One set of n positions, see poisson_disk_layouts
+    return poisson_disk_layouts(1, n, region, min_distance, random=random)[0]
+
+def select(value, index):
+    # A parameter is either one number for every boid or an array with one
+    # value per boid; pick the values for index either way
+    return value if np.ndim(value) == 0 else value[index]
+
+def tree_pairs(pos, radius):
+    # Every ordered pair of boids within radius of each other
+    pairs = cKDTree(pos).query_pairs(radius, output_type='ndarray')
+    return np.concatenate((pairs[:, 0], pairs[:, 1])), np.concatenate((pairs[:, 1], pairs[:, 0]))
+
+def interaction_matrix(weights=None):
+    # Species x species weights (rows: the boid reacting, columns: the
+    # neighbour it reacts to), one for every pair of colours, from
+    # {(Color, Color): weight}. Unlisted pairs weigh 1
+    matrix = np.ones((len(Color), len(Color)))
+    for (color, other), weight in (weights or {}).items():
+        matrix[color.value, other.value] = weight
+    return matrix
+
+def flocking_forces(pos, vel, i_idx, j_idx, visual_range, separation_distance, alignment, coherence, separation, out=None,
+                    pair_weights=None):
+    # Alignment, cohesion and separation for every boid at once, from a list
+    # of candidate neighbour pairs (i_idx[k] sees j_idx[k]). pair_weights,
+    # if given, is (3, pairs): how much each pair counts towards alignment,
+    # cohesion and separation. 0 ignores the neighbour and negative weights
+    # turn the rule around; averages are over the neighbours' absolute
+    # weights. Written to out when given
+    n = len(pos)
+    offsets = pos[j_idx] - pos[i_idx]
+    dists = np.sqrt(np.einsum('ij,ij->i', offsets, offsets))
+    near = dists < select(visual_range, i_idx)
+    avoid = dists < select(separation_distance, i_idx)
+
+    i_near, j_near = i_idx[near], j_idx[near]
+    near_counts = np.bincount(i_near, minlength=n)
+    has_near = near_counts > 0
+
+    if out is None:
+        forces = np.zeros_like(vel)
+    else:
+        forces = out
+        forces.fill(0)
+    if pair_weights is not None:
+        return weighted_forces(pos, vel, i_idx, i_near, j_near, near, avoid, offsets, pair_weights, alignment, coherence,
+                               separation, forces)
+    for axis in range(2):
+        # alignment
+        vel_sum = np.bincount(i_near, weights=vel[j_near, axis], minlength=n)
+        forces[has_near, axis] += vel_sum[has_near] / near_counts[has_near] * select(alignment, has_near)
+
+        # cohesion
+        pos_sum = np.bincount(i_near, weights=pos[j_near, axis], minlength=n)
+        forces[has_near, axis] += (pos_sum[has_near] / near_counts[has_near] - pos[has_near, axis]) * select(coherence, has_near)
+
+        # separation
+        forces[:, axis] -= np.bincount(i_idx[avoid], weights=offsets[avoid, axis], minlength=n) * separation
+
+    return forces
+
+def weighted_forces(pos, vel, i_idx, i_near, j_near, near, avoid, offsets, pair_weights, alignment, coherence,
+                    separation, forces):
+    # flocking_forces with per-pair weights: the same bincounts, each over
+    # weighted values, so mixed species cost no more than one
+    n = len(pos)
+    align_weights, cohere_weights = pair_weights[0, near], pair_weights[1, near]
+    align_counts = np.bincount(i_near, weights=np.abs(align_weights), minlength=n)
+    cohere_counts = np.bincount(i_near, weights=np.abs(cohere_weights), minlength=n)
+    cohere_sums = np.bincount(i_near, weights=cohere_weights, minlength=n)
+    has_align = align_counts > 0
+    has_cohere = cohere_counts > 0
+    separate_weights = pair_weights[2, avoid]
+
+    for axis in range(2):
+        # alignment
+        vel_sum = np.bincount(i_near, weights=vel[j_near, axis] * align_weights, minlength=n)
+        forces[has_align, axis] += vel_sum[has_align] / align_counts[has_align] * select(alignment, has_align)
+
+        # cohesion, towards the weighted centre of the neighbours
+        pos_sum = np.bincount(i_near, weights=pos[j_near, axis] * cohere_weights, minlength=n)
+        pull = pos_sum[has_cohere] - pos[has_cohere, axis] * cohere_sums[has_cohere]
+        forces[has_cohere, axis] += pull / cohere_counts[has_cohere] * select(coherence, has_cohere)
+
+        # separation
+        forces[:, axis] -= np.bincount(i_idx[avoid], weights=offsets[avoid, axis] * separate_weights, minlength=n) * separation
+
+    return forces
+
+def dot_drift(noise, steering, jitter, out=None, random=None):
+    # Force on each dot of a kinematogram: the steering force, (2,) or (n, 2),
+    # for coherent dots, and a random nudge with a standard deviation of
+    # jitter for the noise dots. With out and random, a np.random.Generator,
+    # the nudges are drawn straight into out for every dot and the coherent
+    # dots' overwritten, so nothing is allocated
+    if out is None or random is None:
+        drift = np.array(np.broadcast_to(steering, (len(noise), 2)))
+        drift[noise] = np.random.normal(0, 1, (np.count_nonzero(noise), 2)) * np.reshape(select(jitter, noise), (-1, 1))
+        return drift
+    random.standard_normal(dtype=out.dtype, out=out)
+    out *= np.reshape(jitter, (-1, 1)) if np.ndim(jitter) else jitter
+    np.copyto(out, steering, where=~noise[:, None])
+    return out
+
+def orientations(vel, out=None):
+    # Heading of each boid in degrees, clockwise from straight up
+    oris = np.arctan2(vel[:,0], vel[:,1], out=out)
+    np.degrees(oris, out=oris)
+    return np.mod(oris, 360, out=oris)
+
+def edge_avoidance(pos, lower, upper, edge_distance, edge_force, soft=True, out=None, gaps=None):
+    # Push boids back once they come within edge_distance of the edges of the
+    # region from lower to upper, along the axes where soft is True. lower,
+    # upper and soft are (2,) or (n, 2). Written to out when given, with the
+    # distances to each edge worked out in gaps, an (n,) array, so nothing
+    # is allocated
+    if out is None:
+        out = np.zeros((len(pos), 2), dtype=pos.dtype)
+    else:
+        out.fill(0)
+    if gaps is None:
+        gaps = np.empty(len(pos), dtype=pos.dtype)
+    soft = np.asarray(soft)
+
+    for axis in range(2):
+        soft_axis = soft[..., axis] if soft.ndim else soft
+        if not soft_axis.any():
+            continue
+        force = out[:, axis]
+
+        # Distance to the lower edge, turned into edge_force where it is under
+        # edge_distance and 0 elsewhere
+        np.subtract(pos[:, axis], lower[..., axis], out=gaps)
+        np.less(gaps, edge_distance, out=gaps)
+        if soft_axis.ndim:
+            gaps *= soft_axis
+        gaps *= edge_force
+        force += gaps
+
+        # Likewise for the upper edge, pushing the other way
+        np.subtract(upper[..., axis], pos[:, axis], out=gaps)
+        np.less(gaps, edge_distance, out=gaps)
+        if soft_axis.ndim:
+            gaps *= soft_axis
+        gaps *= edge_force
+        force -= gaps
+
+    return out
+
+def contain(pos, vel, lower, upper, modes):
+    # Keep boids inside the region from lower to upper after a step, in place.
+    # Along axes in REFLECT mode they bounce off the edges, and along axes in
+    # WRAP mode they come back in at the opposite edge. modes is (2,) or (n, 2)
+    reflect = modes == REFLECT
+    if reflect.any():
+        outside = reflect & ((pos <= lower) | (pos >= upper))
+        np.negative(vel, out=vel, where=outside)
+        np.clip(pos, lower, upper, out=pos, where=reflect)
+    wrap = modes == WRAP
+    if wrap.any():
+        np.subtract(pos, lower, out=pos, where=wrap)
+        np.mod(pos, upper - lower, out=pos, where=wrap)
+        np.add(pos, lower, out=pos, where=wrap)
+
+def signed_distance(points, shape):
+    # Distance from each of points (..., 2) to an obstacle shape, negative
+    # inside it. Shapes are ('rect', centre, (width, height)) and
+    # ('circle', centre, radius), in pix
+    kind, centre, size = shape
+    offsets = points - np.asarray(centre, dtype=float)
+    if kind == 'circle':
+        return np.hypot(offsets[..., 0], offsets[..., 1]) - size
+    if kind == 'rect':
+        overhang = np.abs(offsets) - np.asarray(size, dtype=float) / 2
+        outside = np.linalg.norm(np.maximum(overhang, 0), axis=-1)
+        return outside + np.minimum(overhang.max(axis=-1), 0)
+    raise ValueError(f"Obstacle shapes are 'rect' or 'circle', not {kind!r}")
+
+def stim_obstacle(stim):
+    # A PsychoPy Rect or Circle (e.g. a stop-signal frame) as an obstacle shape
+    centre = convertToPix(np.zeros(2), stim.pos, stim.units, stim.win)
+    if isinstance(stim, visual.Circle):
+        radius = convertToPix(np.array([np.ravel(stim.radius)[0], 0.0]), (0, 0), stim.units, stim.win)[0]
+        return ('circle', tuple(float(x) for x in centre), abs(float(radius)))
+    size = convertToPix(np.array([stim.width, stim.height], dtype=float), (0, 0), stim.units, stim.win)
+    return ('rect', tuple(float(x) for x in centre), tuple(abs(float(x)) for x in size))
+
+class ObstacleField:
+    # Static obstacles a flock steers around. The signed distance to the
+    # nearest obstacle and its gradient are sampled once on a grid of cell
+    # pixels covering lower to upper (plus reach), so a boid's repulsion is a
+    # single grid lookup whatever the number or shape of the obstacles.
+    # Boids within reach of an obstacle are pushed straight away from it,
+    # with strength at its edge, growing inside it and fading to 0 at reach
+    def __init__(self, shapes, lower, upper, reach=60, strength=0.5, cell=4):
+        self.shapes = list(shapes)
+        self.reach = reach
+        self.strength = strength
+        self.cell = cell
+        self.origin = np.asarray(lower, dtype=float) - reach
+        xs = np.arange(self.origin[0], upper[0] + reach + cell, cell)
+        ys = np.arange(self.origin[1], upper[1] + reach + cell, cell)
+        points = np.stack(np.meshgrid(xs, ys), axis=-1)
+        # Indexed [row (y), col (x)]
+        self.distance = np.full(points.shape[:2], np.inf)
+        for shape in self.shapes:
+            np.minimum(self.distance, signed_distance(points, shape), out=self.distance)
+        self.gradient = np.zeros(points.shape)
+        if self.shapes and min(self.distance.shape) > 1:
+            gradient_y, gradient_x = np.gradient(self.distance, cell)
+            self.gradient[..., 0] = gradient_x
+            self.gradient[..., 1] = gradient_y
+
+    def lookup(self, pos, out=None, gaps=None):
+        # Index into the flattened grid of the cell nearest to each position,
+        # clamped to the grid. Written to out when given, with the rows and
+        # columns worked out in gaps, an (n,) float array
+        if out is None:
+            out = np.empty(len(pos), dtype=int)
+        if gaps is None:
+            gaps = np.empty(len(pos))
+        # Rows (y) first, then columns (x) added on
+        for axis in (1, 0):
+            np.subtract(pos[:, axis], self.origin[axis], out=gaps)
+            gaps /= self.cell
+            gaps += 0.5
+            np.floor(gaps, out=gaps)
+            np.clip(gaps, 0, self.distance.shape[1 - axis] - 1, out=gaps)
+            if axis == 1:
+                gaps *= self.distance.shape[1]
+            else:
+                gaps += out
+            np.copyto(out, gaps, casting='unsafe')
+        return out
+
+    def forces(self, pos, out=None, cells=None, gaps=None):
+        # Push on each boid, written to out when given. cells and gaps, (n,)
+        # int and float arrays, hold the lookup, so with all three nothing is
+        # allocated
+        if out is None:
+            out = np.empty(pos.shape)
+        if gaps is None:
+            gaps = np.empty(len(pos))
+        cells = self.lookup(pos, cells, gaps)
+        push = self.distance.ravel().take(cells, out=gaps, mode='clip')
+        push /= self.reach
+        np.subtract(1, push, out=push)
+        np.maximum(push, 0, out=push)
+        push *= self.strength
+        self.gradient.reshape(-1, 2).take(cells, axis=0, out=out, mode='clip')
+        out *= push[:, None]
+        return out
+
+# Passed to the numba kernel for flocks without obstacles
+NO_OBSTACLES = ObstacleField([], (0, 0), (0, 0), reach=1, strength=0)
+
+# Per-step summary statistics of the simulated boids, see flock_metrics
+METRIC_NAMES = ('polarization', 'nearest_neighbour', 'speed', 'near_fixation')
+
+def flock_metrics(pos, vel, flock_ids, i_idx, j_idx, fixation, fixation_radius):
+    # How one step of the flocks looks, from the neighbour pairs the step
+    # already found:
+    #   polarization: length of each flock's mean heading (1 when every boid
+    #     flies the same way, near 0 when headings are random), averaged over
+    #     flocks weighted by size
+    #   nearest_neighbour: mean distance from each boid to its nearest
+    #     neighbour among the pairs (NaN when no boid has one)
+    #   speed: mean speed in pixels per second at STEP_RATE
+    #   near_fixation: number of boids within fixation_radius of fixation
+    speeds = np.sqrt(np.einsum('ij,ij->i', vel, vel))
+    flocks = flock_ids.max() + 1
+    heading_x = np.bincount(flock_ids, weights=vel[:, 0] / speeds, minlength=flocks)
+    heading_y = np.bincount(flock_ids, weights=vel[:, 1] / speeds, minlength=flocks)
+
+    nearest = np.full(len(pos), np.inf)
+    offsets = pos[j_idx] - pos[i_idx]
+    np.minimum.at(nearest, i_idx, np.sqrt(np.einsum('ij,ij->i', offsets, offsets)))
+    found = np.isfinite(nearest)
+
+    offsets = pos - fixation
+    return {
+        'polarization': float(np.hypot(heading_x, heading_y).sum() / len(pos)),
+        'nearest_neighbour': float(nearest[found].mean()) if found.any() else np.nan,
+        'speed': float(speeds.mean() * STEP_RATE),
+        'near_fixation': int(np.count_nonzero(np.einsum('ij,ij->i', offsets, offsets) < fixation_radius ** 2)),
+    }
+
+class FlockMetrics:
+    # Averages flock_metrics over every step since the last reset, e.g. over
+    # a trial. Give one to a Flocks and it is fed from Flocks.update
+    def __init__(self, fixation=(0, 0), fixation_radius=100):
+        self.fixation = np.array(fixation, dtype=float)
+        self.fixation_radius = fixation_radius
+        self.reset()
+
+    def reset(self):
+        self.steps = 0
+        self.totals = dict.fromkeys(METRIC_NAMES, 0.0)
+        self.counts = dict.fromkeys(METRIC_NAMES, 0)
+
+    def add(self, pos, vel, flock_ids, i_idx, j_idx):
+        self.steps += 1
+        for name, value in flock_metrics(pos, vel, flock_ids, i_idx, j_idx, self.fixation, self.fixation_radius).items():
+            if not np.isnan(value):
+                self.totals[name] += value
+                self.counts[name] += 1
+
+    def summary(self):
+        # Mean of each metric (NaN if never measured) and the number of steps
+        means = {name: self.totals[name] / self.counts[name] if self.counts[name] else np.nan for name in METRIC_NAMES}
+        return dict(means, steps=self.steps)
+
+class FixedTimestep:
+    # Turns elapsed wall-clock time into a whole number of simulation steps of
+    # dt seconds, carrying the remainder over to the next frame. Motion speed
+    # then no longer depends on the monitor's refresh rate
+    def __init__(self, step_rate=STEP_RATE, max_steps=5):
+        self.dt = 1 / step_rate
+        # Beyond this many steps per call the extra time is dropped, so a long
+        # gap (e.g. between trials) freezes the flock instead of fast-forwarding it
+        self.max_steps = max_steps
+        self.last_time = None
+        self.accumulator = 0.0
+
+    def reset(self):
+        self.last_time = None
+        self.accumulator = 0.0
+
+    def steps_due(self, now):
+        if self.last_time is None:
+            self.last_time = now
+            return 0
+        self.accumulator += now - self.last_time
+        self.last_time = now
+
+        steps = int(self.accumulator // self.dt)
+        if steps > self.max_steps:
+            self.accumulator %= self.dt
+            return self.max_steps
+        self.accumulator -= steps * self.dt
+        return steps
+
+    def alpha(self):
+        # How far the display time is between the last two steps, from 0 to 1
+        return min(self.accumulator / self.dt, 1.0)
+
+    def set_rate(self, step_rate):
+        self.dt = 1 / step_rate
+        self.accumulator = min(self.accumulator, self.dt)
+
+class FrameGovernor:
+    # Watches frame intervals and simulation cost, and steps the level of
+    # detail of a Flocks down when the frame budget is at risk and back up
+    # once there is headroom again. Every change is kept in changes (and
+    # logged) so it can be saved with the trial data
+    LEVELS = (
+        {'step_rate': STEP_RATE, 'neighbour_interval': 1, 'boid_fraction': 1.0},
+        # Reuse each neighbour search for three steps
+        {'step_rate': STEP_RATE, 'neighbour_interval': 3, 'boid_fraction': 1.0},
+        # Half as many, twice as long steps
+        {'step_rate': STEP_RATE // 2, 'neighbour_interval': 3, 'boid_fraction': 1.0},
+        # Simulate and draw every other boid
+        {'step_rate': STEP_RATE // 2, 'neighbour_interval': 3, 'boid_fraction': 0.5},
+    )
+
+    def __init__(self, frame_rate=60, window=30, hold=60, recover_after=300):
+        self.frame_budget = 1 / frame_rate
+        self.intervals = deque(maxlen=window)
+        self.costs = deque(maxlen=window)
+        # Frames to wait after a change before stepping down again, and before
+        # trying a higher level, so the level does not flicker
+        self.hold = hold
+        self.recover_after = recover_after
+        self.level = 0
+        self.frames_at_level = 0
+        self.last_time = None
+        self.changes = []
+
+    def reset(self):
+        # Forget the last frame, e.g. between blocks, so the gap does not count
+        # as a late frame. The level is kept, as the machine has not changed
+        self.last_time = None
+        self.intervals.clear()
+        self.costs.clear()
+
+    def detail(self):
+        return self.LEVELS[self.level]
+
+    def frame(self, now, update_cost):
+        # Call once per frame with the frame time and the seconds spent
+        # simulating; returns True when the level changed
+        if self.last_time is not None and now - self.last_time < 10 * self.frame_budget:
+            # Longer gaps are pauses between trials rather than late frames
+            self.intervals.append(now - self.last_time)
+        self.last_time = now
+        self.costs.append(update_cost)
+        self.frames_at_level += 1
+        if self.frames_at_level < self.hold or len(self.costs) < self.costs.maxlen:
+            return False
+
+        late = sum(interval > 1.5 * self.frame_budget for interval in self.intervals)
+        cost = np.percentile(self.costs, 90) / self.frame_budget
+        if (late or cost > 0.5) and self.level < len(self.LEVELS) - 1:
+            return self.change(self.level + 1, now, f"{late} late frames, simulation {cost:.0%} of frame")
+        if not late and cost < 0.2 and self.level > 0 and self.frames_at_level >= self.recover_after:
+            return self.change(self.level - 1, now, f"no late frames, simulation {cost:.0%} of frame")
+        return False
+
+    def change(self, level, now, reason):
+        logging.exp(f"Flock level of detail {self.level} -> {level}: {reason}")
+        self.changes.append({'time': round(now, 3), 'level': level, 'reason': reason})
+        self.level = level
+        self.frames_at_level = 0
+        self.intervals.clear()
+        self.costs.clear()
+        return True
+
 # allow for certain number of each color
 
 class Boids:
-    def __init__(self, window, num_boids_map, max_boids_per_cell=5):
+    # Pixels per side of each sprite's tile in the texture atlas
+    tile_size = 256
+
+    def __init__(self, window, num_boids_map, boid_size=32, field_size=None, neighbours=None, compiled=None,
+                 dtype=np.float64, capacity=None, renderer='elements', boundary='soft', region=None, min_distance=None):
+        if compiled and neighbours is not None:
+            raise ValueError("compiled=True does its own neighbour search, so neighbours cannot be chosen with it")
+        # Use the numba kernels whenever numba is available, unless told not to,
+        # asked for one of the NumPy neighbour backends or given float32 state
+        if compiled is None:
+            compiled = boids_compiled is not None and neighbours is None and np.dtype(dtype) in COMPILED_DTYPES
+        if neighbours is None:
+            neighbours = 'grid'
+        if neighbours not in NEIGHBOUR_BACKENDS:
+            raise ValueError(f"neighbours must be one of {NEIGHBOUR_BACKENDS}, not {neighbours!r}")
+        if renderer not in RENDERERS:
+            raise ValueError(f"renderer must be one of {RENDERERS}, not {renderer!r}")
+        if np.dtype(dtype) not in STATE_DTYPES:
+            raise ValueError(f"dtype must be float64 or float32, not {dtype!r}")
+        if compiled and boids_compiled is None:
+            raise ValueError("compiled=True needs numba to be installed")
+        if compiled and np.dtype(dtype) not in COMPILED_DTYPES:
+            raise ValueError(f"compiled=True only runs float64 flocks, not {np.dtype(dtype).name}; "
+                             "float32 flocks use the NumPy update")
         self.window = window
+        self.neighbours = neighbours
+        self.renderer = renderer
+        self.compiled = compiled
         self.n = sum(num_boids_map.values())
-        self.grid_size = 40  # Size of each grid cell
-        self.grid_cols = int(WINDOW_WIDTH / self.grid_size) + 1
-        self.grid_rows = int(WINDOW_HEIGHT / self.grid_size) + 1
-        self.max_boids_per_cell = max_boids_per_cell
-        
-        # Initialize grid as a 3D NumPy array
-        self.grid = np.full((self.grid_rows, self.grid_cols, self.max_boids_per_cell), -1, dtype=int)
-        self.grid_counts = np.zeros((self.grid_rows, self.grid_cols), dtype=int)
-
-        self.pos = np.random.rand(self.n, 2) - 0.5
-        self.pos[:,0] *= WINDOW_WIDTH
-        self.pos[:,1] *= WINDOW_HEIGHT
-        self.vel = ((np.random.rand(self.n, 2) - 0.5) * 3)
-        self.acc = np.zeros((self.n, 2))
-        self.magnitudes = np.zeros((self.n, 1))
-        self.unit_vectors = np.zeros((self.n, 2))
-        self.intrinsic_speeds = ((np.random.rand(self.n, 1) * 0.1) + 0.9) * 1.1
-
-        prefix_sum_nums = np.cumsum([0] + list(num_boids_map.values())).tolist()
-        self.split_indices = list(zip(prefix_sum_nums, prefix_sum_nums[1:])) # where to split between one color and the next in arrs
+        self.boid_size = boid_size
+        # Type of all the per-boid state, and of the grid cells and indices
+        self.dtype = np.dtype(dtype)
+        self.index_dtype = STATE_DTYPES[self.dtype]
 
-        # Initialize the grid
-        self.update_grid()
+        # Width and height of the area the flock lives in, centred on the origin
+        if field_size is None:
+            field_size = (WINDOW_WIDTH, WINDOW_HEIGHT)
+        self.field_size = np.array(field_size, dtype=float)
+        self.half_size = (self.field_size / 2).astype(self.dtype)
+        self.set_boundary(boundary, region)
 
-        # Load all images
-        downscale_dims = (256, 256)
-        shape_height = 32 # fix height
+        self.pos = self.random_positions(self.n).astype(self.dtype, copy=False)
+        self.vel = ((np.random.rand(self.n, 2) - 0.5) * 3).astype(self.dtype, copy=False)
+        self.intrinsic_speeds = (((np.random.rand(self.n, 1) * 0.1) + 0.9) * 1.1).astype(self.dtype, copy=False)
+        # Spacing and region of the last spread, which reset repeats
+        self.min_distance = None
+        self.spread_region = None
+        if min_distance is not None:
+            self.spread(min_distance)
 
-        self.texture_dict = {}
-        for c in [Color.BLUE, Color.RED, Color.YELLOW, Color.GREEN]:
-            img = Image.open(color_filename_lookup[c])
-            img.load()
-            img.thumbnail(downscale_dims)
-            data = (np.asarray(img, dtype="int32") / 255) * 2 - 1
-            data = data[::-1,]
+        self.num_boids_map = num_boids_map
+        # Which atlas tile each boid is drawn with. Colours need not be
+        # contiguous, as the whole flock is drawn in one call
+        self.color_ids = color_ids(num_boids_map)
+        # Times update_colors changed the flock, so Flocks.show can tell
+        # when to recrop its sprites
+        self.recolours = 0
 
-            self.texture_dict[c] = (data, img.size[0] * shape_height / img.size[1])
-        
-        self.shapes = []
-        for color, (start, end) in zip(num_boids_map.keys(), self.split_indices):
-            self.shapes += [
-                ElementArrayStim(
-                    self.window, 
-                    units='pix', 
-                    nElements=end - start, 
-                    fieldSize=(WINDOW_WIDTH, WINDOW_HEIGHT), 
-                    fieldShape="sqr", 
-                    sizes=(self.texture_dict[color][1], shape_height), 
-                    elementTex=self.texture_dict[color][0], 
-                    elementMask=np.ones(downscale_dims))
-            ]
+        # Flocking, or a random-dot kinematogram, see set_kinematogram
+        self.behaviour = 'flocking'
+        self.motion_coherence = 1.0
+        self.direction = 90
+        self.steering = 0.3
+        self.jitter = 0.1
+        self.pick_coherent()
+
+        # Room for this many boids before update_colors has to reallocate
+        self.allocate_storage(max(self.n, capacity or 0))
+
+        # Fixed-rate stepping with interpolated drawing, see advance_to
+        self.timestep = FixedTimestep()
+        self.prev_pos = None
+        self.render_pos = None
+
+        # Precomputed motion replayed instead of simulating, see play_trajectory
+        self.trajectory = None
+        # Simulation running in another process, see follow_process
+        self.process = None
 
         self.edge_distance = 100 # Distance from edge to start turning
         self.edge_force = 0.3   # Strength of edge repulsion
 
-    def edge_avoidance(self):
-        # Calculate distance to edges
-        left_edge = self.pos[:, 0] + WINDOW_WIDTH/2
-        right_edge = WINDOW_WIDTH/2 - self.pos[:, 0]
-        bottom_edge = self.pos[:, 1] + WINDOW_HEIGHT/2
-        top_edge = WINDOW_HEIGHT/2 - self.pos[:, 1]
+        # Flocking parameters, see set_parameters
+        self.coherence = 0.0005
+        self.separation = 0.004
+        self.alignment = 0.1
+        self.visual_range = 40
+        self.separation_distance = 30
+        # Per-species weights of the rules, see set_interactions
+        self.interactions = None
+        # Static shapes the flock steers around, see set_obstacles
+        self.obstacles = None
 
-        # Calculate repulsion forces
-        force_x = np.zeros(self.n)
-        force_y = np.zeros(self.n)
+        self.setup_boids()
 
-        mask = left_edge < self.edge_distance
-        # force_x[mask] += (self.edge_distance - left_edge[mask]) * self.edge_force
-        force_x[mask] += self.edge_force
+        if self.compiled:
+            # Compile (or load from numba's cache) now rather than on the first
+            # frame of a trial
+            self.compiled_update(self.pos.copy(), self.vel.copy())
 
-        mask = right_edge < self.edge_distance
-        # force_x[mask] -= (self.edge_distance - right_edge[mask]) * self.edge_force
-        force_x[mask] -=  self.edge_force
+    def allocate_storage(self, capacity):
+        # Arrays for up to capacity boids, keeping the current boids' rows. The
+        # per-boid attributes (pos, vel, ...) are views of their first n rows
+        self.storage = {}
+        for name, shape in STATE_SHAPES.items():
+            self.storage[name] = np.zeros((capacity,) + shape, dtype=FIXED_STATE_DTYPES.get(name, self.dtype))
+            if getattr(self, name, None) is not None:
+                self.storage[name][:self.n] = getattr(self, name)
+        self.capacity = capacity
+        self.bind_storage()
 
-        mask = bottom_edge < self.edge_distance
-        force_y[mask] +=  self.edge_force
-        # force_y[mask] += (self.edge_distance - bottom_edge[mask]) * self.edge_force
+    def bind_storage(self):
+        for name, array in self.storage.items():
+            setattr(self, name, array[:self.n])
 
-        mask = top_edge < self.edge_distance
-        # force_y[mask] -= (self.edge_distance - top_edge[mask]) * self.edge_force
-        force_y[mask] -= self.edge_force
+    def setup_boids(self):
+        # Initialize the grid
+        self.update_grid()
+
+        self.atlas, self.aspect_ratios = texture_atlas(self.tile_size)
+        self.shapes = [self.make_stim(self.n)]
+        self.set_sprites(self.shapes[0], self.color_ids, self.sprite_sizes())
+
+    def make_stim(self, n):
+        # One stimulus for n boids of any colours, textured with the atlas
+        if self.renderer == 'instanced':
+            try:
+                return boids_renderer.InstancedSprites(self.window, n, self.atlas, ATLAS_TILES)
+            except Exception as error:
+                logging.warning(f"Drawing boids with ElementArrayStim instead: {error}")
+                self.renderer = 'elements'
+        return ElementArrayStim(
+            self.window,
+            units='pix',
+            nElements=n,
+            fieldSize=tuple(self.field_size),
+            fieldShape="sqr",
+            sizes=self.boid_size,
+            elementTex=self.atlas,
+            elementMask=None)
+
+    def sprite_sizes(self):
+        # Width and height of each boid's sprite, at a fixed height
+        heights = np.full(self.n, float(self.boid_size))
+        return np.column_stack((self.aspect_ratios[self.color_ids] * heights, heights))
+
+    @staticmethod
+    def set_sprites(stim, color_ids, sizes):
+        if isinstance(stim, boids_renderer.InstancedSprites):
+            stim.setSprites(color_ids, sizes)
+            return
+        sfs, phases = atlas_coords(color_ids)
+        stim.setSizes(sizes, log=False)
+        stim.setSfs(sfs, log=False)
+        stim.setPhases(phases, log=False)
+
+    def set_parameters(self, coherence=None, separation=None, alignment=None, visual_range=None, separation_distance=None):
+        if coherence is not None:
+            self.coherence = coherence
+        if separation is not None:
+            self.separation = separation
+        if alignment is not None:
+            self.alignment = alignment
+        if visual_range is not None:
+            self.visual_range = visual_range
+        if separation_distance is not None:
+            self.separation_distance = separation_distance
+
+    def set_boundary(self, mode='soft', region=None):
+        # Keep the flock inside region (left, right, bottom, top), by default
+        # the whole field, in one of BOUNDARY_MODES
+        if mode not in BOUNDARY_MODES:
+            raise ValueError(f"boundary must be one of {tuple(BOUNDARY_MODES)}, not {mode!r}")
+        if region is None:
+            region = (-self.half_size[0], self.half_size[0], -self.half_size[1], self.half_size[1])
+        left, right, bottom, top = region
+        self.boundary = mode
+        self.lower = np.array([left, bottom], dtype=self.dtype)
+        self.upper = np.array([right, top], dtype=self.dtype)
+        self.axis_modes = np.array(BOUNDARY_MODES[mode])
+        self.soft_axes = self.axis_modes == SOFT
+        # The obstacle grid covers the region, so is redrawn over the new one
+        obstacles = getattr(self, 'obstacles', None)
+        if obstacles is not None:
+            self.set_obstacles(obstacles.shapes, obstacles.reach, obstacles.strength, obstacles.cell)
+
+    def set_kinematogram(self, motion_coherence, direction=90, steering=0.3, jitter=0.1):
+        # Move as a random-dot kinematogram instead of a flock: a random
+        # motion_coherence fraction of the boids flock with each other and
+        # steer towards direction (degrees clockwise from straight up, so 90
+        # is right and 270 left); the rest are noise dots, which wander at
+        # random and ignore every other boid, so they cost no neighbour
+        # search. Usually paired with a 'wrap' or 'wrap_x' boundary
+        self.behaviour = 'kinematogram'
+        self.motion_coherence = motion_coherence
+        self.direction = direction
+        self.steering = steering
+        self.jitter = jitter
+        # The noise dots' nudges, drawn from the global random state once so
+        # np.random.seed still repeats them
+        self.jitter_random = np.random.default_rng(np.random.randint(2 ** 31))
+        self.pick_coherent()
+
+    def set_flocking(self):
+        self.behaviour = 'flocking'
+        self.pick_coherent()
+
+    def pick_coherent(self):
+        # noise marks the boids that fly at random, none of them when flocking
+        self.noise = np.zeros(self.n, dtype=bool)
+        if self.behaviour == 'kinematogram':
+            self.noise[np.random.permutation(self.n)[round(self.motion_coherence * self.n):]] = True
+        self.coherent = np.flatnonzero(~self.noise)
 
-        return np.column_stack((force_x, force_y))
+    def steering_force(self):
+        # Force pulling coherent dots towards direction, zero when flocking
+        if self.behaviour != 'kinematogram':
+            return np.zeros(2)
+        angle = np.radians(self.direction)
+        return np.array([np.sin(angle), np.cos(angle)]) * self.steering
+
+    def coherent_pairs(self):
+        # Neighbour pairs among the coherent dots only, found with a KD-tree
+        # over just them
+        i_idx, j_idx = tree_pairs(self.pos[self.coherent], max(self.visual_range, self.separation_distance))
+        return self.coherent[i_idx], self.coherent[j_idx]
+
+    def kinematogram_forces(self):
+        # Flocking among the coherent dots, plus each dot's drift
+        forces = self.flocking_forces(*self.coherent_pairs())
+        forces += dot_drift(self.noise, self.steering_force(), self.jitter, self.drift, self.jitter_random)
+        return forces
+
+    def region(self):
+        # (left, right, bottom, top) of the flock's region, see set_boundary
+        return self.lower[0], self.upper[0], self.lower[1], self.upper[1]
+
+    def random_positions(self, count, random=np.random):
+        # count positions spread evenly over the flock's region
+        lower, upper = self.lower.astype(float), self.upper.astype(float)
+        return (random.rand(count, 2) - 0.5) * (upper - lower) + (lower + upper) / 2
+
+    def spread(self, min_distance, region=None, random=np.random):
+        # Place the boids at random but at least min_distance apart, inside
+        # region (by default the flock's own), so sprites do not overlap and
+        # the density is the same every time
+        self.min_distance = min_distance
+        self.spread_region = region
+        self.pos[:] = poisson_disk_layout(self.n, self.region() if region is None else region, min_distance, random)
+        self.prev_pos = None
+
+    def set_interactions(self, alignment=None, cohesion=None, separation=None):
+        # How strongly each colour reacts to each other colour under each
+        # rule, as {(Color, Color): weight} for interaction_matrix, e.g.
+        #   boids.set_interactions(alignment={(Color.RED, other): 0 for other in Color if other != Color.RED},
+        #                          cohesion={(Color.YELLOW, Color.BLUE): -1})
+        # makes red boids align with red ones only and yellow boids shy away
+        # from blue ones. With no arguments every colour is treated alike again
+        if alignment is None and cohesion is None and separation is None:
+            self.interactions = None
+            return
+        self.interactions = np.array([interaction_matrix(weights) for weights in (alignment, cohesion, separation)])
+
+    def pair_weights(self, i_idx, j_idx):
+        # (3, pairs) weights of the neighbour pairs, gathered by colour
+        if self.interactions is None:
+            return None
+        return self.interactions[:, self.color_ids[i_idx], self.color_ids[j_idx]]
+
+    def set_obstacles(self, shapes, reach=60, strength=0.5, cell=4):
+        # Keep the flock off static shapes such as a central stimulus, given
+        # as ('rect', centre, (width, height)) or ('circle', centre, radius)
+        # in pix, or from PsychoPy stims with stim_obstacle, e.g.
+        #   boids.set_obstacles([stim_obstacle(stop_signal)])
+        # The shapes are rasterised once here; with none the flock flies freely
+        if not shapes:
+            self.obstacles = None
+            return
+        self.obstacles = ObstacleField(shapes, self.lower, self.upper, reach, strength, cell)
+
+    def edge_avoidance(self):
+        if self.compiled:
+            return boids_compiled.edge_avoidance(self.pos, self.lower, self.upper, self.soft_axes,
+                                                 float(self.edge_distance), float(self.edge_force), self.edge_forces)
+        return edge_avoidance(self.pos, self.lower, self.upper, self.edge_distance, self.edge_force, self.soft_axes,
+                              self.edge_forces, self.edge_gaps)
+
+    def hash_cells(self, cells):
+        # Bucket in the spatial hash table for each (col, row) grid cell
+        return ((cells[..., 0] * 73856093) ^ (cells[..., 1] * 19349663)) & (self.table_size - 1)
 
     def update_grid(self):
-        # Clear the grid
-        self.grid.fill(-1)
-        self.grid_counts.fill(0)
-
-        # Calculate grid indices for all boids
-        grid_indices = np.floor((self.pos + np.array([WINDOW_WIDTH/2, WINDOW_HEIGHT/2])) / self.grid_size).astype(int)
-        
-        # Clip indices to ensure they're within bounds
-        grid_indices = np.clip(grid_indices, [0, 0], [self.grid_cols-1, self.grid_rows-1])
-
-        # Assign boids to grid cells
-        for i, (col, row) in enumerate(grid_indices):
-            if self.grid_counts[row, col] < self.max_boids_per_cell:
-                self.grid[row, col, self.grid_counts[row, col]] = i
-                self.grid_counts[row, col] += 1
+        # Counting sort of the boids by hashed grid cell. The boids in bucket b
+        # are grid_order[grid_starts[b]:grid_starts[b] + grid_counts[b]]; the
+        # table has about 2 buckets per boid, whatever the window size
+        # Cells are at least as wide as the largest interaction radius, so every
+        # neighbour is within the 3x3 block of cells around a boid
+        self.grid_size = max(self.visual_range, self.separation_distance)
+        self.table_size = 1 << max(2 * self.n - 1, 1).bit_length()
+        self.cells = np.floor(self.pos / self.grid_size).astype(self.index_dtype)
+        buckets = self.hash_cells(self.cells)
 
-    def get_nearby_boids(self, i):
-        pos = self.pos[i]
-        col, row = np.floor((pos + np.array([WINDOW_WIDTH/2, WINDOW_HEIGHT/2])) / self.grid_size).astype(int)
+        self.grid_order = np.argsort(buckets, kind='stable').astype(self.index_dtype, copy=False)
+        self.grid_counts = np.bincount(buckets, minlength=self.table_size).astype(self.index_dtype, copy=False)
+        self.grid_starts = np.cumsum(self.grid_counts, dtype=self.index_dtype) - self.grid_counts
 
-        nearby_cells = self.grid[max(0, row-1):min(self.grid_rows, row+2),
-                                 max(0, col-1):min(self.grid_cols, col+2)]
-        nearby_boids = nearby_cells[nearby_cells != -1]
-        return nearby_boids[nearby_boids != i]
+    def neighbour_buckets(self, cells):
+        # Hash buckets of the 3x3 block of cells around each cell, sorted, with
+        # the count of a bucket zeroed when it repeats so it is only visited once
+        offsets = np.array([(col, row) for row in (-1, 0, 1) for col in (-1, 0, 1)], dtype=cells.dtype)
+        buckets = np.sort(self.hash_cells(cells[:, None, :] + offsets), axis=1)
+        counts = self.grid_counts[buckets]
+        counts[:, 1:][buckets[:, 1:] == buckets[:, :-1]] = 0
+        return self.grid_starts[buckets], counts
 
-    def update(self):
-        self.update_grid()
+    def get_nearby_boids(self, i):
+        starts, counts = self.neighbour_buckets(self.cells[i:i+1])
+        nearby_boids = np.concatenate([self.grid_order[start:start + count] for start, count in zip(starts[0], counts[0])])
+        return nearby_boids[nearby_boids != i]
 
-        new_vel = np.zeros_like(self.vel)
+    def candidate_pairs(self):
+        # Every (boid, other boid) pair sharing a 3x3 block of grid cells. Hash
+        # collisions add a few far-away candidates, which the distance test in
+        # flocking_forces discards
+        starts, counts = self.neighbour_buckets(self.cells)
+        starts, counts = starts.ravel(), counts.ravel()
 
-        for i in range(self.n):
-            nearby_boids = self.get_nearby_boids(i)
-            if len(nearby_boids) == 0:
-                continue
+        run_starts = np.cumsum(counts) - counts
+        within_run = np.arange(counts.sum()) - np.repeat(run_starts, counts)
+        i_idx = np.repeat(np.arange(self.n, dtype=self.index_dtype).repeat(9), counts)
+        j_idx = self.grid_order[np.repeat(starts, counts) + within_run]
+        keep = j_idx != i_idx
+        return i_idx[keep], j_idx[keep]
 
-            nearby_pos = self.pos[nearby_boids]
-            nearby_vel = self.vel[nearby_boids]
+    def tree_pairs(self):
+        return tree_pairs(self.pos, max(self.visual_range, self.separation_distance))
 
-            dists = cdist([self.pos[i]], nearby_pos)[0]
-            within_distance_mask = dists < 40
-            avoid_mask = dists < 30
+    def neighbour_pairs(self):
+        # Both backends find the same neighbours. The KD-tree only returns true
+        # neighbours while the grid also returns everything else in the 3x3
+        # block of cells, so the tree is faster, most of all for clustered
+        # flocks and large visual ranges (see boids_benchmark.py)
+        if self.neighbours == 'kdtree':
+            return self.tree_pairs()
+        self.update_grid()
+        return self.candidate_pairs()
 
-            near_positions = nearby_pos[within_distance_mask]
-            near_velocities = nearby_vel[within_distance_mask]
-            avoid_positions = nearby_pos[avoid_mask]
+    def flocking_forces(self, i_idx, j_idx):
+        return flocking_forces(self.pos, self.vel, i_idx, j_idx, self.visual_range, self.separation_distance,
+                               self.alignment, self.coherence, self.separation, self.forces,
+                               self.pair_weights(i_idx, j_idx))
 
-            # alignment
-            if len(near_velocities) > 0:
-                new_vel[i] += np.mean(near_velocities, axis=0) * 0.1
+    def compiled_update(self, pos, vel):
+        # One update of pos and vel, in place, with the numba kernel. It does
+        # its own spatial hashing, so the neighbours backend does not apply.
+        # Parameters are passed as floats so numba compiles a single version
+        obstacles = NO_OBSTACLES if self.obstacles is None else self.obstacles
+        boids_compiled.update(pos, vel, self.intrinsic_speeds, self.magnitudes, self.unit_vectors,
+                              self.lower, self.upper, self.axis_modes, obstacles.distance, obstacles.gradient,
+                              obstacles.origin, float(obstacles.cell), float(obstacles.reach), float(obstacles.strength),
+                              float(self.visual_range), float(self.separation_distance), float(self.alignment),
+                              float(self.coherence), float(self.separation), float(self.edge_distance),
+                              float(self.edge_force), self.forces, self.edge_forces)
 
-            # cohesion
-            if len(near_positions) > 0:
-                new_vel[i] += (np.mean(near_positions, axis=0) - self.pos[i]) * 0.0005
+    def update(self):
+        self.render_pos = None
+        if self.trajectory is not None:
+            self.replay_step()
+            return
+        if self.process is not None:
+            self.pos[:], self.process_oris = self.process.latest()
+            return
 
-            # separation
-            if len(avoid_positions) > 0:
-                new_vel[i] += np.sum(self.pos[i] - avoid_positions, axis=0) * 0.004
+        # The numba kernel only does plain flocking
+        if self.compiled and self.behaviour == 'flocking' and self.interactions is None:
+            self.compiled_update(self.pos, self.vel)
+            return
 
-        self.vel += new_vel
+        # Everything below works in place, on pos, vel and the scratch buffers
+        if self.behaviour == 'kinematogram':
+            self.vel += self.kinematogram_forces()
+        else:
+            self.vel += self.flocking_forces(*self.neighbour_pairs())
 
-        # Add edge avoidance
+        # Add edge and obstacle avoidance
         edge_forces = self.edge_avoidance()
+        if self.obstacles is not None:
+            edge_forces += self.obstacles.forces(self.pos, self.obstacle_forces, self.obstacle_cells,
+                                                 self.obstacle_push)
         self.vel += edge_forces
 
         # Global behaviors
         # self.vel += -self.pos * 0.0005
-        self.magnitudes = np.linalg.norm(self.vel, axis=1, keepdims=True)
-        self.unit_vectors = self.vel / self.magnitudes
+        magnitudes = self.magnitudes[:, 0]
+        np.einsum('ij,ij->i', self.vel, self.vel, out=magnitudes)
+        np.sqrt(magnitudes, out=magnitudes)
+        np.divide(self.vel, self.magnitudes, out=self.unit_vectors)
         np.clip(self.magnitudes, 1, 2.5, out=self.magnitudes)
-        self.vel = self.unit_vectors * self.magnitudes * self.intrinsic_speeds
+        np.multiply(self.unit_vectors, self.magnitudes, out=self.vel)
+        self.vel *= self.intrinsic_speeds
 
         # Update positions
         self.pos += self.vel
+        # Bounce or wrap at the edges of the region, see set_boundary
+        contain(self.pos, self.vel, self.lower, self.upper, self.axis_modes)
+
+    def play_trajectory(self, positions, orientations):
+        # Replay motion precomputed by boids_replay.py instead of simulating it.
+        # positions is (steps, n, 2) and orientations (steps, n), usually
+        # memory-mapped; each update() moves on one step
+        self.trajectory = (positions, orientations)
+        self.frame = 0
+        self.pos[:] = positions[0]
+        self.prev_pos = None
 
-        # Wrap around screen (optional, can be removed if you want boids to stay within screen)
-        # self.pos[:, 0] = (self.pos[:, 0] + WINDOW_WIDTH/2) % WINDOW_WIDTH - WINDOW_WIDTH/2
-        # self.pos[:, 1] = (self.pos[:, 1] + WINDOW_HEIGHT/2) % WINDOW_HEIGHT - WINDOW_HEIGHT/2
+    def replay_step(self):
+        positions, orientations = self.trajectory
+        # Hold the last step once the recording runs out
+        self.frame = min(self.frame + 1, len(positions) - 1)
+        self.pos[:] = positions[self.frame]
+
+    def follow_process(self, process):
+        # Draw the flock simulated by a boids_process.FlockProcess: each
+        # update() copies its newest positions and orientations
+        self.process = process
+        self.update()
+
+    def step_n(self, k):
+        # Advance k simulation steps at once, e.g. to burn in a new flock
+        for step in range(k):
+            if step == k - 1:
+                self.save_prev_pos()
+            self.update()
+
+    def advance_to(self, now):
+        # Run however many fixed steps are due by time now (in seconds, e.g.
+        # core.getTime()) and place the boids between the last two steps for
+        # drawing. Call once per frame instead of update()
+        if self.process is not None:
+            # The other process keeps its own time; just take its latest state
+            self.update()
+            return
+
+        self.step_n(self.timestep.steps_due(now))
+        self.interpolate(self.timestep.alpha())
+
+    def save_prev_pos(self):
+        if self.prev_pos is None or self.prev_pos.shape != self.pos.shape:
+            self.prev_pos = self.pos.copy()
+        else:
+            self.prev_pos[:] = self.pos
+
+    def interpolate(self, alpha):
+        # Drawing positions alpha of the way from prev_pos to pos
+        if self.prev_pos is None or self.prev_pos.shape != self.pos.shape:
+            self.prev_pos = self.pos.copy()
+        np.subtract(self.pos, self.prev_pos, out=self.render_buffer)
+        # A boid that wrapped round in the last step is drawn carrying on past
+        # the edge it left by, rather than sliding back across the region
+        size = self.upper - self.lower
+        for axis in np.flatnonzero(self.axis_modes == WRAP):
+            steps = self.render_buffer[:, axis]
+            steps -= size[axis] * np.round(steps / size[axis])
+        self.render_buffer *= alpha
+        self.render_buffer += self.prev_pos
+        self.render_pos = self.render_buffer
+
+    def current_oris(self):
+        if self.trajectory is not None:
+            return self.trajectory[1][self.frame]
+        if self.process is not None:
+            return self.process_oris
+        return orientations(self.vel, out=self.oris)
 
     def show(self):
-        oris = np.degrees(np.arctan2(self.vel[:,0], self.vel[:,1])) % 360
+        pos = self.pos if self.render_pos is None else self.render_pos
+        shape = self.shapes[0]
+        shape.setOris(self.current_oris())
+        shape.setXYs(pos)
+        shape.draw()
+
+    def release(self):
+        # Free the flock's stimuli, once it will not be drawn again
+        for shape in self.shapes:
+            release_stim(shape)
+        self.shapes = []
+
+    def reset(self, seed=None):
+        # Start over as a Boids made right after np.random.seed(seed) would:
+        # new positions, velocities and speeds, written into the existing
+        # arrays, inside the region and spread min_distance apart again if
+        # the flock was. Parameters, stimuli and buffers are kept, so this is
+        # much cheaper than making a new Boids. Without a seed the global
+        # random state is used
+        random = np.random if seed is None else np.random.RandomState(seed)
+        self.pos[:] = self.random_positions(self.n, random)
+        self.vel[:] = (random.rand(self.n, 2) - 0.5) * 3
+        self.intrinsic_speeds[:] = ((random.rand(self.n, 1) * 0.1) + 0.9) * 1.1
+        if self.min_distance is not None:
+            self.spread(self.min_distance, self.spread_region, random)
+        self.acc.fill(0)
+        self.magnitudes.fill(0)
+        self.unit_vectors.fill(0)
+
+        self.timestep.reset()
+        self.prev_pos = None
+        self.render_pos = None
+        self.trajectory = None
+        self.process = None
+
+    def update_colors(self, num_boids_map):
+        # Change how many boids of each colour there are. Existing boids keep
+        # their position, velocity and speed, so their motion carries on; only
+        # added boids get new random ones, inside the flock's region, and
+        # removed boids are dropped from the end. The arrays are only
+        # reallocated (to twice the size) when the flock outgrows its capacity
+        if list(num_boids_map.items()) == list(self.num_boids_map.items()):
+            return
+        new_ids = color_ids(num_boids_map)
+        n = len(new_ids)
+        if n > self.capacity:
+            self.allocate_storage(max(n, 2 * self.capacity))
+
+        added = slice(self.n, n)
+        self.n = n
+        self.bind_storage()
+        if added.start < n:
+            count = n - added.start
+            self.pos[added] = self.random_positions(count)
+            self.vel[added] = (np.random.rand(count, 2) - 0.5) * 3
+            self.intrinsic_speeds[added] = ((np.random.rand(count, 1) * 0.1) + 0.9) * 1.1
+
+        # Recolour only the boids whose colour changed
+        changed = np.flatnonzero(self.color_ids != new_ids)
+        self.color_ids[changed] = new_ids[changed]
+        self.num_boids_map = num_boids_map
+        self.recolours += 1
+        self.pick_coherent()
+
+        if self.shapes:
+            # Recrop the sprites to the new colours, on a new stimulus if the
+            # number of boids changed
+            if self.shapes[0].nElements != self.n:
+                release_stim(self.shapes[0])
+                self.shapes[0] = self.make_stim(self.n)
+            self.set_sprites(self.shapes[0], self.color_ids, self.sprite_sizes())
 
-        for shape, (start, end) in zip(self.shapes, self.split_indices):
-            shape.setOris(oris[start:end])
-            shape.setXYs(self.pos[start:end,:])
-            shape.draw()
-    
     def randomize_positions(self):
-        self.pos = np.random.rand(self.n, 2) - 0.5
-        self.pos[:,0] *= WINDOW_WIDTH
-        self.pos[:,1] *= WINDOW_HEIGHT
+        self.pos[:] = self.random_positions(self.n)
+        self.prev_pos = None
 
     def randomize_velocities(self):
-        self.vel = ((np.random.rand(self.n, 2) - 0.5) * 3)
+        self.vel[:] = (np.random.rand(self.n, 2) - 0.5) * 3
+
+class HeadlessBoids(Boids):
+    # Simulation only, for precomputing and benchmarking: no textures or
+    # stimuli are made, so no window is needed
+    def setup_boids(self):
+        self.update_grid()
+        self.shapes = []
+
+class BoidsPool:
+    # Flocks made ahead of time (e.g. at startup) and handed out reset, so a
+    # trial can take one without paying for grids, textures and stimuli
+    #
+    #   pool = BoidsPool(lambda: Boids(win, {Color.BLUE: 75, Color.GREEN: 25}))
+    #   boids = pool.acquire()
+    #   ...
+    #   pool.release(boids)
+    def __init__(self, make, size=2):
+        self.make = make
+        self.free = [make() for _ in range(size)]
+
+    def acquire(self, seed=None):
+        # A flock reset with seed (see Boids.reset). Only makes a new one if
+        # every pooled flock is in use
+        boids = self.free.pop() if self.free else self.make()
+        boids.reset(seed)
+        return boids
+
+    def release(self, boids):
+        self.free.append(boids)
+
+class Flocks:
+    # Several independent Boids flocks advanced together in one vectorized
+    # step. Each added flock's pos, vel and intrinsic_speeds become views into
+    # shared arrays with a flock id column, so stepping four flocks costs about
+    # the same as stepping one. A flock keeps its own parameters (set through
+    # its set_parameters) and its own region and boundary mode (set through
+    # its set_boundary)
+    def __init__(self):
+        self.flocks = {}
+        self.packed = []
+        self.pos = np.zeros((0, 2))
+        self.vel = np.zeros((0, 2))
+        self.intrinsic_speeds = np.zeros((0, 1))
+        self.flock_ids = np.zeros(0, dtype=int)
+        self.timestep = FixedTimestep()
+        # Stimuli for drawing several flocks at once, by number of boids, see
+        # prepare. Each comes with what it was last cropped for and buffers
+        # its orientations and positions are gathered into
+        self.stims = {}
+        # Flocks drawn by the last show, for set_detail
+        self.shown = None
+
+        # Level of detail, see set_detail; a FrameGovernor, if given, sets it
+        # from the measured frame times
+        self.governor = None
+        # A FlockMetrics, if given, is fed every step
+        self.metrics = None
+        self.step_scale = 1.0
+        self.neighbour_interval = 1
+        self.stride = 1
+        self.pairs = None
+
+    def add(self, name, boids, bounds=None):
+        # bounds (left, right, bottom, top) is short for
+        # boids.set_boundary('reflect', bounds)
+        if bounds is not None:
+            boids.set_boundary('reflect', bounds)
+        self.flocks[name] = boids
+        boids.prev_pos = None
+
+    def remove(self, name):
+        self.flocks.pop(name, None)
+
+    def release(self):
+        # Free the stimuli made by show, once no flock will be drawn again
+        for stim, *_ in self.stims.values():
+            release_stim(stim)
+        self.stims.clear()
+
+    def clear(self):
+        self.flocks.clear()
+        self.timestep.reset()
+        if self.governor is not None:
+            self.governor.reset()
+
+    def set_detail(self, step_rate, neighbour_interval, boid_fraction):
+        # Run step_rate steps a second, moving boids as far per second as at
+        # STEP_RATE; search for neighbours every neighbour_interval steps; and
+        # simulate and draw only about boid_fraction of each flock (every other
+        # boid at 0.5, so colour ratios are kept)
+        self.timestep.set_rate(step_rate)
+        self.step_scale = STEP_RATE / step_rate
+        self.neighbour_interval = neighbour_interval
+        self.stride = max(1, round(1 / boid_fraction))
+        self.pairs = None
+        self.prepare(self.shown)
+
+    def strides(self):
+        # Every stride show may draw with: the current one, and those of the
+        # governor's levels
+        strides = {self.stride}
+        if self.governor is not None:
+            strides.update(max(1, round(1 / level['boid_fraction'])) for level in self.governor.LEVELS)
+        return strides
+
+    def prepare(self, names=None):
+        # Make the stimuli show needs to draw the named flocks (all of them by
+        # default) at every stride, ahead of the frames that draw them, as
+        # making one uploads its texture. Call once the flocks for a trial
+        # are added and recoloured
+        flocks = [boids for name, boids in self.flocks.items() if names is None or name in names]
+        for stride in self.strides():
+            n = sum(len(range(0, boids.n, stride)) for boids in flocks)
+            if n and n not in self.stims:
+                self.stims[n] = [flocks[0].make_stim(n), None, np.zeros(n), np.zeros((n, 2))]
+
+    def is_packed(self):
+        if self.packed != list(self.flocks):
+            return False
+        # A flock that outgrew its capacity (in update_colors) has new arrays
+        # that no longer point into the shared ones
+        return all(boids.storage['pos'].base is self.pos and boids.storage['vel'].base is self.vel
+                   and boids.storage['intrinsic_speeds'].base is self.intrinsic_speeds for boids in self.flocks.values())
+
+    def pack(self):
+        # Copy every flock's state into the shared arrays and point the
+        # flocks at their slices of them. Each flock gets rows for its whole
+        # capacity, so it can change size without being packed again
+        flocks = list(self.flocks.values())
+        # Mixed precisions are packed at the widest of them
+        dtype = np.result_type(*[boids.pos for boids in flocks]) if flocks else np.float64
+        self.pos = np.concatenate([boids.storage['pos'] for boids in flocks] + [np.zeros((0, 2), dtype=dtype)])
+        self.vel = np.concatenate([boids.storage['vel'] for boids in flocks] + [np.zeros((0, 2), dtype=dtype)])
+        self.intrinsic_speeds = np.concatenate([boids.storage['intrinsic_speeds'] for boids in flocks]
+                                               + [np.zeros((0, 1), dtype=dtype)])
+        self.flock_ids = np.repeat(np.arange(len(flocks)), [boids.capacity for boids in flocks]).astype(int)
+        # Row of each boid within its own flock; rows from a flock's n up are unused
+        self.member_index = np.concatenate([np.arange(boids.capacity) for boids in flocks] + [np.zeros(0, dtype=int)])
+        self.starts = np.cumsum([0] + [boids.capacity for boids in flocks[:-1]]).astype(int)
+        self.pairs = None
+
+        start = 0
+        for boids in flocks:
+            end = start + boids.capacity
+            boids.storage['pos'] = self.pos[start:end]
+            boids.storage['vel'] = self.vel[start:end]
+            boids.storage['intrinsic_speeds'] = self.intrinsic_speeds[start:end]
+            boids.bind_storage()
+            start = end
+        self.packed = list(self.flocks)
+
+    def update(self, names=None):
+        # Advance the named flocks (all of them by default) by one step
+        if not self.is_packed():
+            self.pack()
+
+        # Flocks replaying a precomputed trajectory or following another
+        # process are not simulated here; they fetch their next state themselves
+        replaying = [name for name, boids in self.flocks.items()
+                     if (boids.trajectory is not None or boids.process is not None) and (names is None or name in names)]
+        for name in replaying:
+            self.flocks[name].update()
+        if replaying:
+            names = [name for name in (self.flocks if names is None else names) if name not in replaying]
+        for name, boids in self.flocks.items():
+            if names is None or name in names:
+                boids.render_pos = None
+
+        # The rows in use of the named flocks, or every other one and so on
+        # at lower levels of detail (see set_detail)
+        counts = np.array([boids.n for boids in self.flocks.values()], dtype=int)
+        keep = self.member_index < counts[self.flock_ids]
+        if self.stride > 1:
+            keep &= self.member_index % self.stride == 0
+        if names is not None:
+            rows = [row for row, name in enumerate(self.flocks) if name in names]
+            keep &= np.isin(self.flock_ids, rows)
+        active = slice(None) if keep.all() else np.flatnonzero(keep)
+        pos, vel, flock_ids = self.pos[active], self.vel[active], self.flock_ids[active]
+        if len(pos) == 0:
+            return
+
+        # Parameters are read from the flocks every step, so set_parameters
+        # on a flock takes effect straight away
+        params = np.array([[boids.visual_range, boids.separation_distance, boids.alignment, boids.coherence,
+                            boids.separation, boids.edge_distance, boids.edge_force]
+                           for boids in self.flocks.values()], dtype=float)
+        visual_range, separation_distance, alignment, coherence, separation, edge_distance, edge_force = params[flock_ids].T
+        # Likewise each flock's region and boundary mode, one row per flock
+        # picked per boid with flock_ids
+        lower = np.array([boids.lower for boids in self.flocks.values()], dtype=float)[flock_ids]
+        upper = np.array([boids.upper for boids in self.flocks.values()], dtype=float)[flock_ids]
+        modes = np.array([boids.axis_modes for boids in self.flocks.values()])[flock_ids]
+
+        # Noise dots of flocks moving as kinematograms (see
+        # Boids.set_kinematogram), which are left out of the neighbour search
+        noise = None
+        if any(boids.behaviour == 'kinematogram' for boids in self.flocks.values()):
+            noise = np.zeros(len(self.pos), dtype=bool)
+            for start, boids in zip(self.starts, self.flocks.values()):
+                noise[start:start + boids.n] = boids.noise
+            noise = noise[active]
+        searchable = slice(None) if noise is None else np.flatnonzero(~noise)
+
+        # Neighbour search over all flocks at once, keeping pairs from the same
+        # flock. At lower levels of detail the pairs are reused for a few
+        # steps; flocking_forces still checks their current distances
+        searched_for = (None if names is None else tuple(names), self.stride, tuple(counts),
+                        None if noise is None else np.count_nonzero(noise))
+        if self.pairs is None or self.pairs[0] != searched_for or self.pairs[1] >= self.neighbour_interval:
+            i_idx, j_idx = tree_pairs(pos[searchable], max(params[:, 0].max(), params[:, 1].max()))
+            if noise is not None:
+                i_idx, j_idx = searchable[i_idx], searchable[j_idx]
+            same_flock = flock_ids[i_idx] == flock_ids[j_idx]
+            self.pairs = [searched_for, 0, i_idx[same_flock], j_idx[same_flock]]
+        self.pairs[1] += 1
+        i_idx, j_idx = self.pairs[2:]
+
+        # Per-species weights (see Boids.set_interactions), gathered per pair
+        # from each flock's matrices by colour
+        pair_weights = None
+        if any(boids.interactions is not None for boids in self.flocks.values()):
+            species = np.zeros(len(self.pos), dtype=int)
+            for start, boids in zip(self.starts, self.flocks.values()):
+                species[start:start + boids.n] = boids.color_ids
+            species = species[active]
+            plain = np.ones((3, len(Color), len(Color)))
+            matrices = np.array([plain if boids.interactions is None else boids.interactions
+                                 for boids in self.flocks.values()])
+            pair_weights = matrices[flock_ids[i_idx], :, species[i_idx], species[j_idx]].T
+
+        vel += flocking_forces(pos, vel, i_idx, j_idx, visual_range, separation_distance, alignment, coherence, separation,
+                               pair_weights=pair_weights)
+        if noise is not None:
+            steering = np.array([boids.steering_force() for boids in self.flocks.values()])[flock_ids]
+            jitter = np.array([boids.jitter for boids in self.flocks.values()])[flock_ids]
+            vel += dot_drift(noise, steering, jitter)
+        edge_forces = edge_avoidance(pos, lower, upper, edge_distance, edge_force, modes == SOFT)
+        # Each flock's own obstacles (see Boids.set_obstacles), looked up in
+        # its own distance field
+        for row, boids in enumerate(self.flocks.values()):
+            if boids.obstacles is not None:
+                rows = flock_ids == row
+                edge_forces[rows] += boids.obstacles.forces(pos[rows])
+        vel += edge_forces
+
+        magnitudes = np.linalg.norm(vel, axis=1, keepdims=True)
+        unit_vectors = vel / magnitudes
+        np.clip(magnitudes, 1, 2.5, out=magnitudes)
+        vel = unit_vectors * magnitudes * self.intrinsic_speeds[active]
+        pos += vel * self.step_scale
+
+        # Every flock's boundary in one pass
+        contain(pos, vel, lower, upper, modes)
+
+        if self.metrics is not None:
+            self.metrics.add(pos, vel, flock_ids, i_idx, j_idx)
+
+        self.pos[active] = pos
+        self.vel[active] = vel
+
+    def step_n(self, k, names=None):
+        for step in range(k):
+            if step == k - 1:
+                for boids in self.flocks.values():
+                    boids.save_prev_pos()
+            self.update(names)
+
+    def advance_to(self, now, names=None):
+        # As Boids.advance_to, with one clock for all the flocks
+        started = time.perf_counter()
+        self.step_n(self.timestep.steps_due(now), names)
+        alpha = self.timestep.alpha()
+        for name, boids in self.flocks.items():
+            if names is None or name in names:
+                boids.interpolate(alpha)
+
+        # Only frames with boids on screen say anything about their cost
+        if self.governor is not None and any(names is None or name in names for name in self.flocks):
+            if self.governor.frame(now, time.perf_counter() - started):
+                self.set_detail(**self.governor.detail())
+
+    def show(self, names=None):
+        # Draw the named flocks (all of them by default) in a single draw call
+        flocks = [boids for name, boids in self.flocks.items() if names is None or name in names]
+        if not flocks:
+            return
+        self.shown = names
+        # Only the boids being simulated, see set_detail
+        every = slice(None, None, self.stride)
+        n = sum(len(range(0, boids.n, self.stride)) for boids in flocks)
+        if n == 0:
+            return
+        if n not in self.stims:
+            # Not prepared ahead of time
+            self.prepare(names)
+        entry = self.stims[n]
+        stim, cropped_for, oris, xys = entry
+        drawing = (self.stride,) + tuple((boids, boids.recolours) for boids in flocks)
+        if cropped_for != drawing:
+            # Colours or flocks changed; recrop the elements to their tiles
+            Boids.set_sprites(stim, np.concatenate([boids.color_ids[every] for boids in flocks]),
+                              np.concatenate([boids.sprite_sizes()[every] for boids in flocks]))
+            entry[1] = drawing
+
+        stim.setOris(np.concatenate([boids.current_oris()[every] for boids in flocks], out=oris))
+        stim.setXYs(np.concatenate([(boids.pos if boids.render_pos is None else boids.render_pos)[every]
+                                    for boids in flocks], out=xys))
+        stim.draw()
 
 # win = visual.Window([WINDOW_WIDTH, WINDOW_HEIGHT], units="pix", color=(1, 1, 1))
 # win.refreshThreshold = 1/60 + 0.001
@@ -0,0 +1,294 @@
+# Times the Boids simulation without opening a window.
+#
+#   python boids_benchmark.py             full suite, results saved as JSON
+#   python boids_benchmark.py --quick     smaller suite for a quick check
+#   python boids_benchmark.py --backends  neighbour backend comparison only
+#   python boids_benchmark.py --allocations  per-boid arrays allocated per frame
+#   python boids_benchmark.py --dtypes    float32 against float64 state
+#
+# The suite times Boids.update, update_grid, edge_avoidance and show for
+# flocks of 10 to 10,000 boids, sparse and dense, at several visual ranges,
+# with float64 and float32 state, and reports latency percentiles against the frame budget at 60, 120 and
+# 144 Hz. Results go to benchmark_results/ so runs can be compared over time.
+# show is timed against stub stimuli, so it covers the per-frame array work
+# but not the OpenGL upload and draw.
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import tracemalloc
+import numpy as np
+import boids as boids_module
+from boids import HeadlessBoids, Color, BACKENDS, NEIGHBOUR_BACKENDS, STATE_DTYPES, COMPILED_DTYPES, boids_compiled
+from boids import backend_options
+from boids_calibration import time_call
+
+DTYPES = tuple(dtype.name for dtype in STATE_DTYPES)
+
+REFRESH_RATES = (60, 120, 144)
+RESULTS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_results")
+
+# Dense layouts with more expected neighbours per boid than this are skipped,
+# as the neighbour pair arrays alone would need gigabytes
+MAX_EXPECTED_NEIGHBOURS = 400
+
+class StubWindow:
+    # Only the attributes the simulation reads
+    def __init__(self, size=(1000, 800)):
+        self.size = np.array(size)
+
+class StubStim:
+    # Takes the place of ElementArrayStim in show()
+    def __init__(self, n):
+        self.nElements = n
+        # Converted to float32 as PsychoPy does, into arrays kept between frames
+        self.xys = np.zeros((n, 2), dtype=np.float32)
+        self.oris = np.zeros(n, dtype=np.float32)
+
+    def setXYs(self, xys):
+        self.xys[:] = xys
+
+    def setOris(self, oris):
+        self.oris[:] = oris
+
+    def draw(self):
+        pass
+
+def make_flock(num_boids, backend, visual_range, clustered, seed=0, dtype='float64'):
+    np.random.seed(seed)
+    window = StubWindow()
+    boids = HeadlessBoids(window, {Color.BLUE: num_boids}, field_size=window.size, dtype=dtype, **backend_options(backend))
+    boids.set_parameters(visual_range=visual_range, separation_distance=visual_range * 0.75)
+    if clustered:
+        # Squeeze the flock into a quarter of the field
+        boids.pos *= 0.25
+    return boids
+
+def expected_neighbours(num_boids, visual_range, clustered, field_size=(1000, 800)):
+    area = field_size[0] * field_size[1] * (0.25 ** 2 if clustered else 1)
+    return num_boids * np.pi * visual_range ** 2 / area
+
+def time_update(boids, steps=50, warmup=5):
+    return time_call(boids.update, min_samples=steps, max_samples=steps, max_seconds=0, warmup=warmup)
+
+def summarise(timings):
+    p50, p95, p99 = np.percentile(timings, [50, 95, 99]) * 1000
+    summary = {
+        'samples': len(timings),
+        'p50_ms': float(p50),
+        'p95_ms': float(p95),
+        'p99_ms': float(p99),
+        'max_ms': float(timings.max() * 1000),
+    }
+    # Share of each frame budget used by the slowest 1% of calls
+    for rate in REFRESH_RATES:
+        summary[f'p99_budget_{rate}hz'] = float(p99 / (1000 / rate))
+    return summary
+
+def run_suite(flock_sizes=(10, 100, 1000, 10000), visual_ranges=(40, 80, 160), backends=BACKENDS, dtypes=DTYPES):
+    results = []
+    for num_boids in flock_sizes:
+        for visual_range in visual_ranges:
+            for clustered in (False, True):
+                layout = 'dense' if clustered else 'sparse'
+                config = {'boids': num_boids, 'visual_range': visual_range, 'layout': layout}
+                neighbours = expected_neighbours(num_boids, visual_range, clustered)
+                if neighbours > MAX_EXPECTED_NEIGHBOURS:
+                    results.append(dict(config, skipped=f"{neighbours:.0f} expected neighbours per boid"))
+                    continue
+                for backend in backends:
+                    for dtype in dtypes:
+                        if backend == 'compiled' and np.dtype(dtype) not in COMPILED_DTYPES:
+                            continue
+                        boids = make_flock(num_boids, backend, visual_range, clustered, dtype=dtype)
+                        boids.shapes = [StubStim(boids.n)]
+                        calls = {
+                            'update': boids.update,
+                            'update_grid': boids.update_grid,
+                            'edge_avoidance': boids.edge_avoidance,
+                            'show': boids.show,
+                        }
+                        for name, function in calls.items():
+                            results.append(dict(config, backend=backend, dtype=dtype, call=name, **summarise(time_call(function))))
+                            print_result(results[-1])
+    return results
+
+def print_result(result):
+    budgets = " ".join(f"{result[f'p99_budget_{rate}hz']:>6.1%}" for rate in REFRESH_RATES)
+    print(f"{result['boids']:>6} {result['visual_range']:>5} {result['layout']:>6} {result['backend']:>8} "
+          f"{result['dtype']:>7} {result['call']:>14} {result['p50_ms']:>9.3f} {result['p95_ms']:>9.3f} {result['p99_ms']:>9.3f}   {budgets}")
+
+def save_results(results, directory=RESULTS_DIRECTORY):
+    os.makedirs(directory, exist_ok=True)
+    now = datetime.datetime.now()
+    filename = os.path.join(directory, f"boids_{now:%Y%m%d_%H%M%S}.json")
+    with open(filename, 'w') as f:
+        json.dump({
+            'timestamp': now.isoformat(),
+            'machine': platform.node(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'numba': boids_compiled is not None,
+            'refresh_rates': REFRESH_RATES,
+            'results': results,
+        }, f, indent=1)
+    return filename
+
+def compare_backends(flock_sizes=(10, 100, 1000, 2000), visual_ranges=(40, 80, 120)):
+    print(f"{'boids':>6} {'range':>6} {'layout':>9} " + " ".join(f"{name:>10}" for name in BACKENDS) + "   fastest")
+    for num_boids in flock_sizes:
+        for visual_range in visual_ranges:
+            for clustered in (False, True):
+                medians = {}
+                for backend in BACKENDS:
+                    boids = make_flock(num_boids, backend, visual_range, clustered)
+                    medians[backend] = np.median(time_update(boids)) * 1000
+                fastest = min(medians, key=medians.get)
+                layout = 'clustered' if clustered else 'spread'
+                print(f"{num_boids:>6} {visual_range:>6} {layout:>9} " + " ".join(f"{medians[name]:>8.3f}ms" for name in BACKENDS) + f"   {fastest}")
+
+def compare_dtypes(flock_sizes=(100, 1000, 5000), visual_range=40):
+    # Update throughput in boid steps per second, float32 against float64.
+    # Only the NumPy backends run float32 flocks
+    print(f"{'boids':>6} {'backend':>8} " + " ".join(f"{name:>14}" for name in DTYPES) + "  speedup")
+    for num_boids in flock_sizes:
+        for backend in NEIGHBOUR_BACKENDS:
+            throughput = {}
+            for dtype in DTYPES:
+                boids = make_flock(num_boids, backend, visual_range, clustered=False, dtype=dtype)
+                throughput[dtype] = num_boids / np.median(time_update(boids))
+            print(f"{num_boids:>6} {backend:>8} " + " ".join(f"{throughput[name]:>10.3g}/s   " for name in DTYPES)
+                  + f"  {throughput['float32'] / throughput['float64']:>6.2f}x")
+
+# Functions of boids.py that find neighbour pairs or work through them. Their
+# arrays grow with the number of pairs, which changes every frame, so they are
+# allocated every step and frame_allocations leaves them out
+NEIGHBOUR_PAIR_CODE = {'neighbour_pairs', 'update_grid', 'neighbour_buckets', 'hash_cells', 'candidate_pairs',
+                       'tree_pairs', 'flocking_forces', 'weighted_forces', 'pair_weights', 'coherent_pairs',
+                       'compiled_update'}
+
+def frame_allocations(boids, frames=5, warmup=10):
+    # The largest block of memory each line of boids.py allocated during
+    # frames of update + show, however briefly it was held, as
+    # {(function, line): bytes}. The trace follows every line run in
+    # boids.py; lines that call into NEIGHBOUR_PAIR_CODE are left out
+    for _ in range(warmup):
+        boids.update()
+        boids.show()
+
+    filename = boids_module.__file__
+    largest = {}
+    # Line being measured and the memory traced when it started, or None
+    # between lines and inside neighbour pair code
+    line = [None, 0]
+    pair_depth = [0]
+
+    def end_line():
+        if line[0] is not None:
+            grown = tracemalloc.get_traced_memory()[1] - line[1]
+            largest[line[0]] = max(largest.get(line[0], 0), grown)
+        line[0] = None
+
+    def start_line(frame):
+        if frame is None or frame.f_code.co_filename != filename:
+            return
+        tracemalloc.reset_peak()
+        line[:] = [(frame.f_code.co_name, frame.f_lineno), tracemalloc.get_traced_memory()[0]]
+
+    def trace_line(frame, event, arg):
+        if event == 'line':
+            end_line()
+            start_line(frame)
+        elif event == 'return':
+            # The rest of the calling line is measured as part of it
+            end_line()
+            start_line(frame.f_back)
+        return trace_line
+
+    def trace_pairs(frame, event, arg):
+        if event == 'return':
+            pair_depth[0] -= 1
+            if pair_depth[0] == 0:
+                start_line(frame.f_back)
+        return trace_pairs
+
+    def trace_call(frame, event, arg):
+        if pair_depth[0] or frame.f_code.co_filename != filename:
+            return None
+        end_line()
+        if frame.f_code.co_name in NEIGHBOUR_PAIR_CODE:
+            pair_depth[0] += 1
+            frame.f_trace_lines = False
+            return trace_pairs
+        return trace_line
+
+    tracemalloc.start()
+    sys.settrace(trace_call)
+    try:
+        for _ in range(frames):
+            boids.update()
+            boids.show()
+    finally:
+        sys.settrace(None)
+        tracemalloc.stop()
+    return largest
+
+# Ways report_allocations sets the flocks up: plain flocking, a
+# kinematogram, and flocking around obstacles
+ALLOCATION_SETUPS = ('flocking', 'kinematogram', 'obstacles')
+ALLOCATION_OBSTACLES = [('rect', (0, 0), (200, 150)), ('circle', (250, 150), 60)]
+
+def report_allocations(flock_sizes=(10000, 20000), visual_range=40):
+    # Every per-boid array update and show need is preallocated, so no line
+    # outside the neighbour pair code may allocate as much as one (n,) array
+    # of flock state, even for a moment. The flocks are big enough that such
+    # an array is larger than NumPy's own ufunc buffers (8192 elements),
+    # which broadcasting and casting operations allocate at any size
+    print(f"{'boids':>6} {'backend':>8} {'setup':>12} {'largest bytes':>14}  line")
+    allocating = []
+    for num_boids in flock_sizes:
+        for backend in BACKENDS:
+            for setup in ALLOCATION_SETUPS:
+                boids = make_flock(num_boids, backend, visual_range, clustered=False)
+                if setup == 'kinematogram':
+                    boids.set_kinematogram(0.5)
+                elif setup == 'obstacles':
+                    boids.set_obstacles(ALLOCATION_OBSTACLES)
+                boids.shapes = [StubStim(boids.n)]
+                largest = frame_allocations(boids)
+                (function, line), size = max(largest.items(), key=lambda item: item[1])
+                print(f"{num_boids:>6} {backend:>8} {setup:>12} {size:>14}  {function}:{line}")
+                limit = boids.n * boids.pos.itemsize
+                allocating += [(num_boids, backend, setup, f"{function}:{line}", size)
+                               for (function, line), size in largest.items() if size >= limit]
+    if allocating:
+        raise SystemExit(f"Frames allocated per-boid arrays: {allocating}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless Boids benchmarks")
+    parser.add_argument('--quick', action='store_true', help="fewer flock sizes and visual ranges")
+    parser.add_argument('--backends', action='store_true', help="only compare neighbour backends")
+    parser.add_argument('--allocations', action='store_true', help="only check frames allocate no per-boid arrays")
+    parser.add_argument('--dtypes', action='store_true', help="only compare float32 and float64 state")
+    args = parser.parse_args()
+
+    if args.backends:
+        compare_backends()
+    elif args.allocations:
+        report_allocations()
+    elif args.dtypes:
+        compare_dtypes()
+    else:
+        print(f"{'boids':>6} {'range':>5} {'layout':>6} {'backend':>8} {'dtype':>7} {'call':>14} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}   "
+              + " ".join(f"{f'{rate}Hz':>6}" for rate in REFRESH_RATES))
+        if args.quick:
+            results = run_suite(flock_sizes=(10, 100, 1000), visual_ranges=(40,))
+        else:
+            results = run_suite()
+        print(f"Saved {save_results(results)}")
@@ -0,0 +1,121 @@
+# Measures the machine a session runs on before its first block, and picks
+# how the boids are simulated there: the fastest backend, and the largest
+# flock (up to the designed size) whose update and draw fit in the frame
+# budget. The results go into the ExperimentHandler's extraInfo, so every
+# row of the data says what the participant actually saw.
+#
+#   calibration = calibrate(win, {Color.BLUE: 75, Color.GREEN: 25})
+#   exp_handler.extraInfo.update(calibration_info(calibration))
+#   boids = Boids(win, scale_flock(num_boids_map, calibration['flock_scale']),
+#                 **backend_options(calibration['backend']))
+#
+# Each call takes a second or two, and leaves the window's back buffer clear.
+
+import time
+import numpy as np
+from psychopy import core
+from boids import Boids, BACKENDS, backend_options
+
+# Fractions of the designed flock size to try, largest first
+FLOCK_SCALES = (1.0, 0.75, 0.5, 0.25)
+
+# Share of each frame the boids may take; the rest is left for the task's own
+# stimuli and for the flip
+BUDGET_SHARE = 0.5
+
+def time_call(function, min_samples=5, max_samples=200, max_seconds=2.0, warmup=3):
+    # Durations of repeated calls to function, in seconds: at least
+    # min_samples, then more until max_seconds or max_samples
+    for _ in range(warmup):
+        function()
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < max_samples and (len(timings) < min_samples or time.perf_counter() - started < max_seconds):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return np.array(timings)
+
+def measure_refresh(win, frames=120):
+    # Refresh rate from back-to-back flips, how much the intervals vary and
+    # the share of them that ran late
+    win.flip()
+    flip_times = np.zeros(frames + 1)
+    for frame in range(frames + 1):
+        win.flip()
+        flip_times[frame] = core.getTime()
+    intervals = np.diff(flip_times)
+    frame_time = np.median(intervals)
+    return {
+        'refresh_rate': float(1 / frame_time),
+        'refresh_sd_ms': float(intervals.std() * 1000),
+        'refresh_late': float(np.mean(intervals > 1.5 * frame_time)),
+    }
+
+def scale_flock(num_boids_map, scale):
+    # num_boids_map with every colour's count scaled, keeping at least one of each
+    return {color: max(1, round(count * scale)) for color, count in num_boids_map.items()}
+
+def frame_cost(update, show, samples=30):
+    # 95th percentile seconds for one update and draw
+    def frame():
+        update()
+        show()
+    return float(np.percentile(time_call(frame, min_samples=samples, max_samples=samples, max_seconds=0), 95))
+
+def largest_fitting(cost_at_scale, budget, scales=FLOCK_SCALES):
+    # First of scales whose cost_at_scale(scale) is within budget, and that cost
+    for scale in scales:
+        cost = cost_at_scale(scale)
+        if cost <= budget:
+            break
+    return scale, cost
+
+def calibrate(win, num_boids_map, backends=BACKENDS, scales=FLOCK_SCALES):
+    # For a single Boids flock, as drawn by the SST variant
+    result = measure_refresh(win)
+    budget = BUDGET_SHARE / result['refresh_rate']
+
+    costs = {}
+    for backend in backends:
+        boids = Boids(win, num_boids_map, **backend_options(backend))
+        costs[backend] = frame_cost(boids.update, boids.show)
+        boids.release()
+    result['backend'] = min(costs, key=costs.get)
+    result['backend_costs_ms'] = {backend: round(cost * 1000, 3) for backend, cost in costs.items()}
+
+    def cost_at_scale(scale):
+        boids = Boids(win, scale_flock(num_boids_map, scale), **backend_options(result['backend']))
+        cost = frame_cost(boids.update, boids.show)
+        boids.release()
+        return cost
+    scale, cost = largest_fitting(cost_at_scale, budget, scales)
+    result['flock_scale'] = scale
+    result['flock_cost_ms'] = round(cost * 1000, 3)
+
+    win.clearBuffer()
+    return result
+
+def calibrate_flocks(win, make_flocks, scales=FLOCK_SCALES):
+    # For several flocks drawn together by a Flocks, as in the CPT.
+    # make_flocks(scale) returns the Flocks with every flock at that scale.
+    # Flocks always search for neighbours with the KD-tree
+    result = measure_refresh(win)
+    budget = BUDGET_SHARE / result['refresh_rate']
+    result['backend'] = 'kdtree'
+
+    def cost_at_scale(scale):
+        flocks = make_flocks(scale)
+        cost = frame_cost(flocks.update, flocks.show)
+        flocks.release()
+        return cost
+    scale, cost = largest_fitting(cost_at_scale, budget, scales)
+    result['flock_scale'] = scale
+    result['flock_cost_ms'] = round(cost * 1000, 3)
+
+    win.clearBuffer()
+    return result
+
+def calibration_info(result):
+    # The results as extraInfo entries, one column each in the saved data
+    return {f"calibration_{key}": value if np.isscalar(value) else str(value) for key, value in result.items()}
@@ -0,0 +1,159 @@
+# Numba versions of the Boids kernels. Importing this module fails when numba
+# is not installed, in which case boids.py stays on its NumPy code path.
+#
+# The kernels follow Boids.flocking_forces, Boids.edge_avoidance,
+# ObstacleField.forces, contain and Boids.update step for step, and visit
+# neighbours in the same order as the 'grid' backend, so both paths give the
+# same trajectories from the same seed.
+
+import numpy as np
+from numba import njit
+
+# Boundary modes per axis, as in boids.py
+SOFT, REFLECT, WRAP = 0, 1, 2
+
+@njit(cache=True)
+def edge_avoidance(pos, lower, upper, soft, edge_distance, edge_force, out):
+    for i in range(pos.shape[0]):
+        force_x = 0.0
+        force_y = 0.0
+        if soft[0]:
+            if pos[i, 0] - lower[0] < edge_distance:
+                force_x += edge_force
+            if upper[0] - pos[i, 0] < edge_distance:
+                force_x -= edge_force
+        if soft[1]:
+            if pos[i, 1] - lower[1] < edge_distance:
+                force_y += edge_force
+            if upper[1] - pos[i, 1] < edge_distance:
+                force_y -= edge_force
+        out[i, 0] = force_x
+        out[i, 1] = force_y
+    return out
+
+@njit(cache=True)
+def contain(pos, vel, lower, upper, modes):
+    for i in range(pos.shape[0]):
+        for axis in range(2):
+            if modes[axis] == REFLECT:
+                if pos[i, axis] <= lower[axis] or pos[i, axis] >= upper[axis]:
+                    vel[i, axis] = -vel[i, axis]
+                pos[i, axis] = min(max(pos[i, axis], lower[axis]), upper[axis])
+            elif modes[axis] == WRAP:
+                pos[i, axis] = lower[axis] + (pos[i, axis] - lower[axis]) % (upper[axis] - lower[axis])
+
+@njit(cache=True)
+def obstacle_forces(pos, distance, gradient, origin, cell, reach, strength, out):
+    # Adds the push away from the obstacles of boids.ObstacleField to out
+    rows, cols = distance.shape
+    for i in range(pos.shape[0]):
+        col = min(max(np.int64(np.floor((pos[i, 0] - origin[0]) / cell + 0.5)), 0), cols - 1)
+        row = min(max(np.int64(np.floor((pos[i, 1] - origin[1]) / cell + 0.5)), 0), rows - 1)
+        if distance[row, col] < reach:
+            push = (1 - distance[row, col] / reach) * strength
+            out[i, 0] += gradient[row, col, 0] * push
+            out[i, 1] += gradient[row, col, 1] * push
+
+@njit(cache=True)
+def hash_cell(col, row, table_size):
+    return ((col * 73856093) ^ (row * 19349663)) & (table_size - 1)
+
+@njit(cache=True)
+def flocking_forces(pos, vel, visual_range, separation_distance, alignment, coherence, separation, out):
+    n = pos.shape[0]
+    cell_size = max(visual_range, separation_distance)
+
+    # Counting sort of the boids by hashed grid cell, as in Boids.update_grid
+    table_size = 1
+    while table_size < 2 * n:
+        table_size *= 2
+    cols = np.empty(n, np.int64)
+    rows = np.empty(n, np.int64)
+    starts = np.zeros(table_size + 1, np.int64)
+    for i in range(n):
+        cols[i] = np.int64(np.floor(pos[i, 0] / cell_size))
+        rows[i] = np.int64(np.floor(pos[i, 1] / cell_size))
+        starts[hash_cell(cols[i], rows[i], table_size) + 1] += 1
+    for b in range(table_size):
+        starts[b + 1] += starts[b]
+    fill = starts[:-1].copy()
+    order = np.empty(n, np.int64)
+    for i in range(n):
+        bucket = hash_cell(cols[i], rows[i], table_size)
+        order[fill[bucket]] = i
+        fill[bucket] += 1
+
+    buckets = np.empty(9, np.int64)
+    for i in range(n):
+        near_count = 0
+        vel_x = vel_y = pos_x = pos_y = sep_x = sep_y = 0.0
+
+        k = 0
+        for d_row in range(-1, 2):
+            for d_col in range(-1, 2):
+                buckets[k] = hash_cell(cols[i] + d_col, rows[i] + d_row, table_size)
+                k += 1
+        # Same bucket order as Boids.neighbour_buckets, so sums are accumulated
+        # in the same order as the NumPy path
+        buckets.sort()
+
+        for k in range(9):
+            # Visit each bucket once, even when neighbouring cells share one
+            if k > 0 and buckets[k] == buckets[k - 1]:
+                continue
+
+            for s in range(starts[buckets[k]], starts[buckets[k] + 1]):
+                j = order[s]
+                if j == i:
+                    continue
+                dx = pos[j, 0] - pos[i, 0]
+                dy = pos[j, 1] - pos[i, 1]
+                dist = np.sqrt(dx * dx + dy * dy)
+                if dist < visual_range:
+                    near_count += 1
+                    vel_x += vel[j, 0]
+                    vel_y += vel[j, 1]
+                    pos_x += pos[j, 0]
+                    pos_y += pos[j, 1]
+                if dist < separation_distance:
+                    sep_x += dx
+                    sep_y += dy
+
+        force_x = 0.0
+        force_y = 0.0
+        if near_count > 0:
+            # alignment
+            force_x += vel_x / near_count * alignment
+            force_y += vel_y / near_count * alignment
+            # cohesion
+            force_x += (pos_x / near_count - pos[i, 0]) * coherence
+            force_y += (pos_y / near_count - pos[i, 1]) * coherence
+        # separation
+        out[i, 0] = force_x - sep_x * separation
+        out[i, 1] = force_y - sep_y * separation
+    return out
+
+@njit(cache=True)
+def update(pos, vel, intrinsic_speeds, magnitudes, unit_vectors, lower, upper, modes, distance, gradient, origin,
+           cell, reach, strength, visual_range, separation_distance, alignment, coherence, separation, edge_distance,
+           edge_force, forces, edge_forces):
+    # forces and edge_forces are (n, 2) scratch arrays owned by the caller
+    n = pos.shape[0]
+    flocking_forces(pos, vel, visual_range, separation_distance, alignment, coherence, separation, forces)
+    edge_avoidance(pos, lower, upper, modes == SOFT, edge_distance, edge_force, edge_forces)
+    obstacle_forces(pos, distance, gradient, origin, cell, reach, strength, edge_forces)
+
+    for i in range(n):
+        vel_x = vel[i, 0] + forces[i, 0] + edge_forces[i, 0]
+        vel_y = vel[i, 1] + forces[i, 1] + edge_forces[i, 1]
+
+        magnitude = np.sqrt(vel_x * vel_x + vel_y * vel_y)
+        unit_vectors[i, 0] = vel_x / magnitude
+        unit_vectors[i, 1] = vel_y / magnitude
+        magnitudes[i, 0] = min(max(magnitude, 1.0), 2.5)
+
+        vel[i, 0] = unit_vectors[i, 0] * magnitudes[i, 0] * intrinsic_speeds[i, 0]
+        vel[i, 1] = unit_vectors[i, 1] * magnitudes[i, 0] * intrinsic_speeds[i, 0]
+        pos[i, 0] += vel[i, 0]
+        pos[i, 1] += vel[i, 1]
+    contain(pos, vel, lower, upper, modes)
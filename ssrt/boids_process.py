@@ -0,0 +1,123 @@
+# Runs a flock simulation in a separate process.
+#
+# The worker steps a HeadlessBoids at a fixed rate and writes positions and
+# orientations into a ring of slots in shared memory. The task process only
+# copies the newest complete slot each frame (Boids.follow_process), so a slow
+# simulation step can no longer hold up win.flip().
+#
+#   flock = FlockProcess({Color.BLUE: 75, Color.GREEN: 25}, seed=1)
+#   flock.start()
+#   boids.follow_process(flock)
+#   ...
+#   flock.stop()
+#
+# The process is started with multiprocessing, so the script that starts it
+# needs an `if __name__ == "__main__":` guard.
+
+import multiprocessing
+import time
+from multiprocessing import shared_memory
+import numpy as np
+from boids import HeadlessBoids, orientations
+
+class FlockBuffer:
+    # Numpy views onto the shared memory block: a header of
+    # [latest slot, stop flag], one sequence number per slot (-1 while the
+    # slot is being written) and the slots themselves
+    def __init__(self, shm, n, slots):
+        self.shm = shm
+        header_bytes = (2 + slots) * 8
+        self.header = np.ndarray((2,), dtype=np.int64, buffer=shm.buf)
+        self.sequence = np.ndarray((slots,), dtype=np.int64, buffer=shm.buf, offset=2 * 8)
+        self.positions = np.ndarray((slots, n, 2), dtype=np.float64, buffer=shm.buf, offset=header_bytes)
+        self.oris = np.ndarray((slots, n), dtype=np.float64, buffer=shm.buf, offset=header_bytes + slots * n * 2 * 8)
+
+    @staticmethod
+    def size(n, slots):
+        return (2 + slots) * 8 + slots * n * 3 * 8
+
+def run_flock(shm_name, num_boids_map, slots, params, field_size, seed, step_rate, obstacles):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    np.random.seed(seed)
+    boids = HeadlessBoids(None, num_boids_map, field_size=field_size)
+    boids.set_parameters(**params)
+    if obstacles:
+        boids.set_obstacles(obstacles)
+    buffer = FlockBuffer(shm, boids.n, slots)
+
+    step = 0
+    dt = 1 / step_rate
+    next_step = time.perf_counter()
+    while not buffer.header[1]:
+        slot = step % slots
+        buffer.sequence[slot] = -1
+        buffer.positions[slot] = boids.pos
+        buffer.oris[slot] = orientations(boids.vel)
+        buffer.sequence[slot] = step
+        buffer.header[0] = slot
+
+        boids.update()
+        step += 1
+        next_step += dt
+        delay = next_step - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            # Fell behind; carry on from now rather than racing to catch up
+            next_step = time.perf_counter()
+
+    # Drop the views before closing the block they point into
+    del buffer
+    shm.close()
+
+class FlockProcess:
+    def __init__(self, num_boids_map, params=None, field_size=None, seed=0, slots=4, step_rate=60, obstacles=None):
+        self.num_boids_map = num_boids_map
+        self.n = sum(num_boids_map.values())
+        self.slots = slots
+        self.shm = shared_memory.SharedMemory(create=True, size=FlockBuffer.size(self.n, slots))
+        self.buffer = FlockBuffer(self.shm, self.n, slots)
+        self.buffer.header[:] = (-1, 0)
+        self.buffer.sequence[:] = -1
+        self.process = multiprocessing.Process(
+            target=run_flock,
+            args=(self.shm.name, num_boids_map, slots, params or {}, field_size, seed, step_rate, obstacles),
+            daemon=True)
+        self.positions = np.zeros((self.n, 2))
+        self.oris = np.zeros(self.n)
+
+    def start(self, timeout=10):
+        # Wait for the first slot, so the flock is ready when this returns
+        self.process.start()
+        deadline = time.perf_counter() + timeout
+        while self.buffer.header[0] < 0:
+            if not self.process.is_alive() or time.perf_counter() > deadline:
+                raise RuntimeError("Flock process failed to start")
+            time.sleep(0.001)
+
+    def latest(self):
+        # Copy of the newest completely written (positions, orientations)
+        while True:
+            slot = self.buffer.header[0]
+            sequence = self.buffer.sequence[slot]
+            self.positions[:] = self.buffer.positions[slot]
+            self.oris[:] = self.buffer.oris[slot]
+            # The slot was not rewritten while being copied
+            if sequence >= 0 and self.buffer.sequence[slot] == sequence:
+                return self.positions, self.oris
+
+    def stop(self):
+        self.buffer.header[1] = 1
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.terminate()
+        del self.buffer
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
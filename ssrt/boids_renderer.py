@@ -0,0 +1,252 @@
+# Instanced drawing of boid sprites.
+#
+# ElementArrayStim rebuilds and re-uploads the vertices of every element on
+# each setXYs / setOris, which dominates Boids.show once flocks reach the low
+# thousands. InstancedSprites draws one textured quad per boid with a single
+# glDrawArraysInstanced call instead: the quad is uploaded once, and each
+# frame only a per-instance buffer of (x, y, orientation, atlas tile) is
+# written, with one glBufferSubData. It takes the place of the ElementArrayStim
+# in Boids.show (Boids(..., renderer='instanced')).
+#
+# It needs OpenGL 3.3, which Mesa's llvmpipe software renderer provides, so it
+# also runs on machines without a GPU. Where 3.3 is missing the constructor
+# raises RuntimeError and Boids falls back to ElementArrayStim.
+#
+# The shader program and the atlas texture are shared by all the sprites
+# drawn in a window; each InstancedSprites only owns its few buffers. release()
+# frees those, and the shared ones once no sprites in the window use them.
+
+import ctypes
+import numpy as np
+import pyglet.gl as GL
+
+VERTEX_SHADER = """
+#version 330
+layout(location = 0) in vec2 corner;    // of a unit quad centred on the origin
+layout(location = 1) in vec4 instance;  // x, y, orientation, atlas tile
+layout(location = 2) in vec2 size;      // width, height
+uniform vec2 half_window;
+uniform float tiles;
+out vec2 tex_coord;
+
+void main() {
+    // Clockwise from straight up, as PsychoPy's ori
+    float angle = radians(instance.z);
+    vec2 offset = corner * size;
+    offset = vec2(offset.x * cos(angle) + offset.y * sin(angle), offset.y * cos(angle) - offset.x * sin(angle));
+    gl_Position = vec4((instance.xy + offset) / half_window, 0.0, 1.0);
+
+    // Tile t is in column t % tiles and row t / tiles of the atlas, as in
+    // boids.atlas_coords
+    float tile = floor(instance.w + 0.5);
+    vec2 cell = vec2(mod(tile, tiles), floor(tile / tiles));
+    tex_coord = (cell + corner + 0.5) / tiles;
+}
+"""
+
+FRAGMENT_SHADER = """
+#version 330
+uniform sampler2D atlas;
+in vec2 tex_coord;
+out vec4 color;
+
+void main() {
+    color = texture(atlas, tex_coord);
+}
+"""
+
+# Corners of the quad each sprite is drawn on, as a triangle strip
+QUAD = np.array([(-0.5, -0.5), (0.5, -0.5), (-0.5, 0.5), (0.5, 0.5)], dtype=np.float32)
+
+def gl_version():
+    # (major, minor) of the current context, e.g. (4, 5) from "4.5 (Compatibility Profile) Mesa ..."
+    version = ctypes.cast(GL.glGetString(GL.GL_VERSION), ctypes.c_char_p).value
+    if version is None:
+        raise RuntimeError("no current OpenGL context")
+    version = version.decode()
+    major, minor = version.split()[0].split('.')[:2]
+    return int(major), int(minor)
+
+def compile_program(vertex_source, fragment_source):
+    program = GL.glCreateProgram()
+    for kind, source in ((GL.GL_VERTEX_SHADER, vertex_source), (GL.GL_FRAGMENT_SHADER, fragment_source)):
+        shader = GL.glCreateShader(kind)
+        text = ctypes.create_string_buffer(source.encode())
+        GL.glShaderSource(shader, 1, ctypes.byref(ctypes.cast(text, ctypes.POINTER(GL.GLchar))), None)
+        GL.glCompileShader(shader)
+        status = GL.GLint()
+        GL.glGetShaderiv(shader, GL.GL_COMPILE_STATUS, ctypes.byref(status))
+        if not status.value:
+            raise RuntimeError(f"Boid shader failed to compile: {info_log(shader, GL.glGetShaderInfoLog)}")
+        GL.glAttachShader(program, shader)
+        # Freed along with the program
+        GL.glDeleteShader(shader)
+    GL.glLinkProgram(program)
+    status = GL.GLint()
+    GL.glGetProgramiv(program, GL.GL_LINK_STATUS, ctypes.byref(status))
+    if not status.value:
+        raise RuntimeError(f"Boid shader failed to link: {info_log(program, GL.glGetProgramInfoLog)}")
+    return program
+
+def info_log(handle, get_log):
+    log = ctypes.create_string_buffer(4096)
+    get_log(handle, len(log), None, ctypes.cast(log, ctypes.POINTER(GL.GLchar)))
+    return log.value.decode(errors='replace')
+
+def create_buffer(data, usage=GL.GL_STATIC_DRAW):
+    buffer = GL.GLuint()
+    GL.glGenBuffers(1, ctypes.byref(buffer))
+    GL.glBindBuffer(GL.GL_ARRAY_BUFFER, buffer)
+    GL.glBufferData(GL.GL_ARRAY_BUFFER, data.nbytes, data.ctypes.data, usage)
+    GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+    return buffer
+
+def upload(buffer, data):
+    # Overwrite the start of buffer with data, without reallocating it
+    GL.glBindBuffer(GL.GL_ARRAY_BUFFER, buffer)
+    GL.glBufferSubData(GL.GL_ARRAY_BUFFER, 0, data.nbytes, data.ctypes.data)
+    GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+
+def create_texture(atlas):
+    # The -1 to 1 float atlas of boids.texture_atlas as an RGBA8 texture,
+    # mipmapped so sprites far smaller than their tiles do not shimmer
+    data = np.ascontiguousarray((atlas + 1) / 2, dtype=np.float32)
+    texture = GL.GLuint()
+    GL.glGenTextures(1, ctypes.byref(texture))
+    GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+    GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGBA8, data.shape[1], data.shape[0], 0, GL.GL_RGBA, GL.GL_FLOAT,
+                    data.ctypes.data)
+    GL.glGenerateMipmap(GL.GL_TEXTURE_2D)
+    GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_LINEAR_MIPMAP_LINEAR)
+    GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_LINEAR)
+    GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
+    GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
+    GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+    return texture
+
+# Programs and textures in use, as {(window, name): [GL name, users]}
+shared = {}
+
+def acquire_shared(window, name, create):
+    # The window's object called name, made with create() for its first user
+    key = (window, name)
+    if key not in shared:
+        shared[key] = [create(), 0]
+    shared[key][1] += 1
+    return shared[key][0]
+
+def release_shared(window, name, delete):
+    key = (window, name)
+    shared[key][1] -= 1
+    if shared[key][1] == 0:
+        delete(shared.pop(key)[0])
+
+def delete_program(program):
+    GL.glDeleteProgram(program)
+
+def delete_texture(texture):
+    GL.glDeleteTextures(1, ctypes.byref(texture))
+
+def delete_buffer(buffer):
+    GL.glDeleteBuffers(1, ctypes.byref(buffer))
+
+def attribute(location, buffer, size, divisor):
+    GL.glBindBuffer(GL.GL_ARRAY_BUFFER, buffer)
+    GL.glEnableVertexAttribArray(location)
+    GL.glVertexAttribPointer(location, size, GL.GL_FLOAT, GL.GL_FALSE, 0, None)
+    GL.glVertexAttribDivisor(location, divisor)
+
+class InstancedSprites:
+    # n sprites from a texture atlas of tiles x tiles, positioned in pix units
+    # from the centre of window. Has the ElementArrayStim methods Boids.show
+    # calls (setXYs, setOris, draw); the tiles and sizes are set together
+    # with setSprites. Call release() once it is no longer drawn
+    def __init__(self, window, n, atlas, tiles):
+        version = gl_version()
+        if version < (3, 3):
+            raise RuntimeError(f"instanced sprites need OpenGL 3.3, this context has {version[0]}.{version[1]}")
+        self.window = window
+        self.nElements = n
+        self.tiles = tiles
+        # x, y, orientation and atlas tile of each sprite, kept between
+        # frames and uploaded whole by draw
+        self.instances = np.zeros((n, 4), dtype=np.float32)
+        self.sizes = np.zeros((n, 2), dtype=np.float32)
+
+        # Anything made before a failure is freed again by release
+        self.program = self.texture = self.vertex_array = None
+        self.buffers = []
+        # Atlases are cached for the whole process (boids.texture_atlas), so
+        # the same array is the same texture
+        self.atlas_name = ('atlas', id(atlas))
+        try:
+            self.program = acquire_shared(window, 'program', lambda: compile_program(VERTEX_SHADER, FRAGMENT_SHADER))
+            self.uniforms = {name: GL.glGetUniformLocation(self.program, name.encode())
+                             for name in ('half_window', 'tiles', 'atlas')}
+            self.texture = acquire_shared(window, self.atlas_name, lambda: create_texture(atlas))
+            self.quad_buffer = create_buffer(QUAD)
+            self.buffers.append(self.quad_buffer)
+            self.instance_buffer = create_buffer(self.instances, GL.GL_STREAM_DRAW)
+            self.buffers.append(self.instance_buffer)
+            self.size_buffer = create_buffer(self.sizes)
+            self.buffers.append(self.size_buffer)
+
+            # The attribute layout and divisors live in their own vertex array
+            # object, so they do not leak into PsychoPy's drawing
+            self.vertex_array = GL.GLuint()
+            GL.glGenVertexArrays(1, ctypes.byref(self.vertex_array))
+            GL.glBindVertexArray(self.vertex_array)
+            attribute(0, self.quad_buffer, 2, 0)
+            attribute(1, self.instance_buffer, 4, 1)
+            attribute(2, self.size_buffer, 2, 1)
+            GL.glBindVertexArray(0)
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+        except Exception:
+            self.release()
+            raise
+
+    def release(self):
+        # Free the GL objects; the sprites cannot be drawn afterwards
+        if self.vertex_array is not None:
+            GL.glDeleteVertexArrays(1, ctypes.byref(self.vertex_array))
+            self.vertex_array = None
+        for buffer in self.buffers:
+            delete_buffer(buffer)
+        self.buffers = []
+        if self.texture is not None:
+            release_shared(self.window, self.atlas_name, delete_texture)
+            self.texture = None
+        if self.program is not None:
+            release_shared(self.window, 'program', delete_program)
+            self.program = None
+
+    def setXYs(self, xys, log=False):
+        self.instances[:, :2] = xys
+
+    def setOris(self, oris, log=False):
+        self.instances[:, 2] = oris
+
+    def setSprites(self, tiles, sizes):
+        # Atlas tile and (width, height) of each sprite; unlike positions and
+        # orientations these only change when the flock is recoloured
+        self.instances[:, 3] = tiles
+        self.sizes[:] = sizes
+        upload(self.size_buffer, self.sizes)
+
+    def draw(self):
+        upload(self.instance_buffer, self.instances)
+
+        GL.glUseProgram(self.program)
+        half_window = np.asarray(self.window.size, dtype=float) / 2
+        GL.glUniform2f(self.uniforms['half_window'], half_window[0], half_window[1])
+        GL.glUniform1f(self.uniforms['tiles'], self.tiles)
+        GL.glUniform1i(self.uniforms['atlas'], 0)
+        GL.glActiveTexture(GL.GL_TEXTURE0)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.texture)
+
+        GL.glBindVertexArray(self.vertex_array)
+        GL.glDrawArraysInstanced(GL.GL_TRIANGLE_STRIP, 0, len(QUAD), self.nElements)
+
+        GL.glBindVertexArray(0)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+        GL.glUseProgram(0)
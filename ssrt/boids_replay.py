@@ -0,0 +1,137 @@
+# Precomputed flock trajectories.
+#
+# A block's boid motion can be simulated before the session and saved as
+# memory-mapped .npy files of positions and orientations. The files are keyed
+# by everything that determines the motion: seed, colours and counts, flocking
+# parameters, field, bounds, obstacles and number of steps. During the task
+# Boids.play_trajectory steps through the recording instead of simulating,
+# so the live run spends no time on the simulation and every participant sees
+# the same motion.
+#
+#   python boids_replay.py 1080
+#
+# fills the cache for the boids block of boids_sst_variant.py ahead of time, at
+# every flock size calibration can pick, for a screen 1080 pixels high (the
+# obstacle the boids avoid is sized from the window).
+
+import hashlib
+import json
+import os
+import sys
+import numpy as np
+from boids import HeadlessBoids, Flocks, Color, orientations
+
+CACHE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "flock_cache")
+
+def trajectory_key(seed, num_boids_map, steps, params=None, field_size=None, bounds=None, obstacles=None):
+    description = {
+        'seed': seed,
+        'boids': [(color.name, count) for color, count in num_boids_map.items()],
+        'steps': steps,
+        'params': sorted((params or {}).items()),
+        'field_size': None if field_size is None else [float(size) for size in field_size],
+        'bounds': None if bounds is None else [float(bound) for bound in bounds],
+    }
+    if bounds is not None:
+        # Bounded flocks have bounced off their bounds without edge avoidance
+        # since boundary modes were added; older recordings do not match
+        description['boundary'] = 'reflect'
+    if obstacles:
+        # Left out otherwise, so recordings without obstacles keep their keys
+        description['obstacles'] = [(kind, [float(x) for x in centre], np.ravel(size).astype(float).tolist())
+                                    for kind, centre, size in obstacles]
+    return hashlib.sha1(json.dumps(description).encode()).hexdigest()[:16]
+
+def trajectory_paths(key, directory=CACHE_DIRECTORY):
+    return os.path.join(directory, f"{key}_pos.npy"), os.path.join(directory, f"{key}_oris.npy")
+
+def precompute_trajectory(seed, num_boids_map, steps, params=None, field_size=None, bounds=None, obstacles=None,
+                          directory=CACHE_DIRECTORY):
+    # Simulate the flock exactly as a live Boids made right after
+    # np.random.seed(seed) would move, and write it to the cache. With bounds
+    # (left, right, bottom, top) the boids start inside them and bounce off
+    # them, as in the CPT distractor areas. obstacles are shapes for
+    # Boids.set_obstacles
+    np.random.seed(seed)
+    boids = HeadlessBoids(None, num_boids_map, field_size=field_size)
+    if bounds is not None:
+        left, right, bottom, top = bounds
+        boids.pos[:, 0] = np.random.uniform(left, right, boids.n)
+        boids.pos[:, 1] = np.random.uniform(bottom, top, boids.n)
+    boids.set_parameters(**(params or {}))
+    if obstacles:
+        boids.set_obstacles(obstacles)
+
+    flocks = None
+    if bounds is not None:
+        flocks = Flocks()
+        flocks.add('flock', boids, bounds)
+
+    os.makedirs(directory, exist_ok=True)
+    key = trajectory_key(seed, num_boids_map, steps, params, field_size, bounds, obstacles)
+    pos_path, oris_path = trajectory_paths(key, directory)
+
+    # Write under temporary names so an interrupted run leaves no half-written cache entry
+    positions = np.lib.format.open_memmap(pos_path + ".partial", mode='w+', dtype=np.float32, shape=(steps, boids.n, 2))
+    oris = np.lib.format.open_memmap(oris_path + ".partial", mode='w+', dtype=np.float32, shape=(steps, boids.n))
+    for step in range(steps):
+        if step > 0:
+            if flocks is not None:
+                flocks.update()
+            else:
+                boids.update()
+        positions[step] = boids.pos
+        oris[step] = orientations(boids.vel)
+    positions.flush()
+    oris.flush()
+    del positions, oris
+    os.replace(pos_path + ".partial", pos_path)
+    os.replace(oris_path + ".partial", oris_path)
+    return key
+
+def load_trajectory(key, directory=CACHE_DIRECTORY):
+    # Memory-mapped (positions, orientations), or None if not cached
+    pos_path, oris_path = trajectory_paths(key, directory)
+    if not (os.path.exists(pos_path) and os.path.exists(oris_path)):
+        return None
+    return np.load(pos_path, mmap_mode='r'), np.load(oris_path, mmap_mode='r')
+
+def load_or_precompute(seed, num_boids_map, steps, params=None, field_size=None, bounds=None, obstacles=None,
+                       directory=CACHE_DIRECTORY):
+    key = trajectory_key(seed, num_boids_map, steps, params, field_size, bounds, obstacles)
+    trajectory = load_trajectory(key, directory)
+    if trajectory is None:
+        precompute_trajectory(seed, num_boids_map, steps, params, field_size, bounds, obstacles, directory)
+        trajectory = load_trajectory(key, directory)
+    return trajectory
+
+# Flock of the boids block in boids_sst_variant.py
+SST_BOIDS_BLOCK = {Color.BLUE: 25, Color.GREEN: 25, Color.RED: 25, Color.YELLOW: 25}
+# Its block number (the seed of its motion) and number of trials
+SST_BLOCK_NUM = 2
+SST_BLOCK_TRIALS = 40
+
+# Side of the square its boids keep clear of, in height units: the go
+# stimulus and the stop signal at the centre, as the stop-signal square of
+# finalssttest.py. boids_sst_variant.py turns it into pix for its window
+SST_OBSTACLE_SIZE = 0.4
+
+def sst_obstacles(window_height):
+    # The obstacle shapes for a window window_height pixels high, as
+    # stim_obstacle gives them for that square
+    side = SST_OBSTACLE_SIZE * window_height
+    return [('rect', (0.0, 0.0), (side, side))]
+
+def sst_block_steps(num_trials, stimulus_duration, step_rate=60):
+    # Boids only move while a trial is on screen; leave 10% spare
+    return int(num_trials * stimulus_duration * step_rate * 1.1)
+
+if __name__ == "__main__":
+    from boids_calibration import FLOCK_SCALES, scale_flock
+    obstacles = sst_obstacles(int(sys.argv[1]) if len(sys.argv) > 1 else 1080)
+    # The block as run_experiment runs it, with the stimulus duration of
+    # run_block_with_boids, at each flock scale calibration may choose
+    for scale in FLOCK_SCALES:
+        key = precompute_trajectory(SST_BLOCK_NUM, scale_flock(SST_BOIDS_BLOCK, scale),
+                                    sst_block_steps(SST_BLOCK_TRIALS, 1.0), obstacles=obstacles)
+        print(f"Cached {key} (flock scale {scale}) in {CACHE_DIRECTORY}")
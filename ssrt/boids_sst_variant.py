@@ -5,7 +5,21 @@ import random
 import psychtoolbox as ptb
 import os
 import numpy as np 
-from boids import Boids, Color
+from boids import Boids, BoidsPool, Color, backend_options, prewarm_textures, stim_obstacle
+import boids_replay
+from boids_process import FlockProcess
+from boids_calibration import calibrate, calibration_info, scale_flock
+
+# Where the boids block gets its motion: 'replay' a precomputed trajectory,
+# simulate in a background 'process', or simulate 'live' in the frame loop
+FLOCK_SOURCE = 'replay'
+
+# Flock shown during distractor trials, at its designed size
+DISTRACTOR_BOIDS = {Color.BLUE: 75, Color.GREEN: 25}
+
+# Backend and flock scale chosen for this machine, and the obstacles sized
+# for its window, set by setup_experiment
+flock_settings = {'backend': None, 'flock_scale': 1.0, 'obstacles': None}
 
 ## rule switching
 
@@ -14,6 +28,14 @@ from boids import Boids, Color
 # - 1 contains distractors
 
 # Configuration
+def make_boids(win, num_boids_map):
+    # A flock with the backend and size calibrated for this machine, flying
+    # around the go stimulus and stop signal rather than over them
+    options = backend_options(flock_settings['backend']) if flock_settings['backend'] else {}
+    boids = Boids(win, scale_flock(num_boids_map, flock_settings['flock_scale']), **options)
+    boids.set_obstacles(flock_settings['obstacles'])
+    return boids
+
 def get_experiment_info():
     exp_info = {
         'participant_id': 0, 'age': 0,
@@ -36,6 +58,29 @@ def setup_experiment(exp_info):
     win = visual.Window([800, 600], color="white", fullscr=True, units='height')
     
     stimuli = create_stimuli(win)
+    # Flocks fly around the go stimulus and stop signal. The area is a
+    # fraction of the screen height, so its size in pix (and the replay
+    # cache key) follows the screen the task runs on
+    clear_area = visual.Rect(win, width=boids_replay.SST_OBSTACLE_SIZE, height=boids_replay.SST_OBSTACLE_SIZE,
+                             units='height')
+    flock_settings['obstacles'] = [stim_obstacle(clear_area)]
+    # Decode the bird sprites now, so no trial has to read image files
+    prewarm_textures()
+
+    # Pick the boids backend and flock size this machine can draw in time,
+    # and save what was picked with every row of the data
+    calibration = calibrate(win, boids_replay.SST_BOIDS_BLOCK)
+    flock_settings.update(backend=calibration['backend'], flock_scale=calibration['flock_scale'])
+    exp_info.update(calibration_info(calibration))
+    if FLOCK_SOURCE == 'replay':
+        # The cache is keyed by the calibrated flock size, so simulate the
+        # boids block now (if not cached) rather than when it starts
+        boids_replay.load_or_precompute(boids_replay.SST_BLOCK_NUM,
+                                        scale_flock(boids_replay.SST_BOIDS_BLOCK, flock_settings['flock_scale']),
+                                        boids_replay.sst_block_steps(boids_replay.SST_BLOCK_TRIALS, 1.0),
+                                        obstacles=flock_settings['obstacles'])
+    # Distractor trials take a ready-made flock instead of building one
+    stimuli['distractor_boids'] = BoidsPool(lambda: make_boids(win, DISTRACTOR_BOIDS))
     
     participant_id = exp_info['participant_id']
     filename = os.path.join(data_directory, f"{participant_id}_sst")
@@ -200,7 +245,7 @@ def run_block_with_distractors(win, stimuli, exp_handler, block_num, num_trials,
 
 def run_trial_distractors(win, stimuli, trial, stop_signal_delay, stimulus_duration, global_clock):
     
-    boids = Boids(win, {Color.BLUE: 75, Color.GREEN: 25})
+    boids = stimuli['distractor_boids'].acquire()
 
     # Select go stimulus
     if random.choice(['left', 'right']) == 'left':
@@ -224,7 +269,7 @@ def run_trial_distractors(win, stimuli, trial, stop_signal_delay, stimulus_durat
 
         go_stim.draw()
 
-        boids.update()
+        boids.advance_to(core.getTime())
 
         win.flip()
 
@@ -269,6 +314,8 @@ def run_trial_distractors(win, stimuli, trial, stop_signal_delay, stimulus_durat
     else:  # stop trial
         accuracy = (response_key is None)  # Correct if no response
 
+    stimuli['distractor_boids'].release(boids)
+
     return {
         'expected_response': expected_response,
         'response_key': response_key,
@@ -414,7 +461,19 @@ def run_block_with_boids(win, stimuli, exp_handler, block_num, num_trials, num_s
     correct_omissions = 0
     
     # Initialize Boids
-    boids = Boids(win, {Color.BLUE: 25, Color.GREEN: 25, Color.RED: 25, Color.YELLOW: 25})
+    num_boids_map = scale_flock(boids_replay.SST_BOIDS_BLOCK, flock_settings['flock_scale'])
+    boids = make_boids(win, boids_replay.SST_BOIDS_BLOCK)
+    flock_process = None
+    if FLOCK_SOURCE == 'replay':
+        # The same precomputed motion for every participant, seeded by the block number
+        steps = boids_replay.sst_block_steps(num_trials, stimulus_duration)
+        boids.play_trajectory(*boids_replay.load_or_precompute(block_num, num_boids_map, steps,
+                                                              obstacles=flock_settings['obstacles']))
+    elif FLOCK_SOURCE == 'process':
+        # Simulate on another core so simulation spikes cannot drop frames
+        flock_process = FlockProcess(num_boids_map, seed=block_num, obstacles=flock_settings['obstacles'])
+        flock_process.start()
+        boids.follow_process(flock_process)
     
     for trial_num, trial in enumerate(trials):
         check_escape()
@@ -443,6 +502,9 @@ def run_block_with_boids(win, stimuli, exp_handler, block_num, num_trials, num_s
         
         if trial_data['rt'] is not None:
             rt_list.append(trial_data['rt'])
+
+    if flock_process is not None:
+        flock_process.stop()
     
     return rt_list, correct_omissions
 
@@ -462,12 +524,16 @@ def run_trial_with_boids(win, stimuli, boids, trial, stop_signal_delay, stimulus
     
     trial_onset = global_clock.getTime()
     
+    # Boids move at a fixed rate whatever the refresh rate; restart their
+    # clock so the time since the last trial is not caught up
+    boids.timestep.reset()
+
     # Go stimulus
     go_onset = global_clock.getTime()
     start_time = core.getTime()
     while core.getTime() - start_time < (stop_signal_delay if trial == "stop" else stimulus_duration):
         go_stim.draw()
-        boids.update()
+        boids.advance_to(core.getTime())
         boids.show()
         win.flip()
         check_escape()
@@ -481,7 +547,7 @@ def run_trial_with_boids(win, stimuli, boids, trial, stop_signal_delay, stimulus
         start_time = core.getTime()
         while core.getTime() - start_time < (stimulus_duration - stop_signal_delay):
             stop_stim.draw()
-            boids.update()
+            boids.advance_to(core.getTime())
             boids.show()
             win.flip()
             check_escape()
@@ -531,7 +597,8 @@ def run_experiment():
         boids_message = visual.TextStim(win, text="You will now proceed to a special block with moving objects!", color='black', height=0.05)
         draw_then_waitkeys(win, boids_message)
         three_two_one(win, global_clock)
-        run_block_with_boids(win, stimuli, exp_handler, 2, 40, 10, global_clock)
+        run_block_with_boids(win, stimuli, exp_handler, boids_replay.SST_BLOCK_NUM, boids_replay.SST_BLOCK_TRIALS, 10,
+                             global_clock)
         
         # Practice blocks
         for block_num in range(2):